@@ -1 +1,13 @@
+import pytest
+
 pytest_plugins = ["pytester"]
+
+
+@pytest.fixture
+def tally_args(pytestconfig, pytester):
+    """Arguments that run pytester's pytest with the plugin and a local data file"""
+    args = ["--tally", f"--tally-file={pytester.path / 'tally-data.json'}"]
+    # An installed pytest-tally is already loaded through its pytest11 entry point
+    if not pytestconfig.pluginmanager.has_plugin("pytest_tally"):
+        args[:0] = ["-p", "pytest_tally.plugin"]
+    return args
@@ -1,6 +1,13 @@
+import heapq
+import threading
+import time
+from typing import Dict, List, Sequence, Set, Tuple
+
 from _pytest.config import Config
 from count_timer import CountTimer
 
+from pytest_tally.utils import TallyCodec, current_rates
+
 
 class TallyCountTimer(CountTimer):
     """
@@ -25,6 +32,32 @@ class TallySession:
     A test session is made up of one or more tests.
     """
 
+    __slots__ = (
+        "session_started",
+        "session_finished",
+        "session_duration",
+        "num_tests_to_run",
+        "num_tests_have_run",
+        "num_tests_running",
+        "num_tests_finished",
+        "outcome_counts",
+        "timer",
+        "lastline",
+        "lastline_ansi",
+        "tally_tests",
+        "tally_table",
+        "workers",
+        "completion_fraction",
+        "eta",
+        "rates",
+        "slowest",
+        "config",
+        "lock",
+        "_fragments",
+        "_fragments_codec",
+        "_pending",
+    )
+
     def __init__(
         self,
         config: Config,
@@ -32,34 +65,158 @@ class TallySession:
         session_finished: bool = False,
         num_tests_to_run: int = 0,
         num_tests_have_run: int = 0,
+        num_tests_running: int = 0,
+        num_tests_finished: int = 0,
+        outcome_counts: dict = None,
         session_duration: float = 0.0,
         lastline: str = "",
         lastline_ansi: str = "",
-        timer: TallyCountTimer = TallyCountTimer(),
-        tally_tests: dict = {},
+        timer: TallyCountTimer = None,
+        tally_tests: dict = None,
+        tally_table: str = None,
+        workers: dict = None,
+        completion_fraction: float = None,
+        eta: float = None,
+        rates: dict = None,
+        slowest: dict = None,
     ) -> None:
         self.session_started = session_started
         self.session_finished = session_finished
         self.session_duration = session_duration
         self.num_tests_to_run = num_tests_to_run
         self.num_tests_have_run = num_tests_have_run
-        self.timer = timer
+        # Kept up to date as tests start and finish, so that progress can be
+        # read without scanning tally_tests
+        self.num_tests_running = num_tests_running
+        self.num_tests_finished = num_tests_finished
+        self.outcome_counts = (
+            outcome_counts
+            if outcome_counts is not None
+            else dict.fromkeys(TallyRates.OUTCOMES, 0)
+        )
+        self.timer = timer if timer is not None else TallyCountTimer()
         self.lastline = lastline
         self.lastline_ansi = lastline_ansi
-        self.tally_tests = tally_tests
+        self.tally_tests = tally_tests if tally_tests is not None else {}
+        self.tally_table = tally_table
+        self.workers = workers if workers is not None else {}
+        # Share of the expected total test time that has finished, and the
+        # estimated seconds left; None until there is a duration history
+        self.completion_fraction = completion_fraction
+        self.eta = eta
+        self.rates = rates
+        self.slowest = slowest
         self.config = config
+        # Guards tally_tests against being serialized by a background writer
+        # while a hook is adding to it
+        self.lock = threading.RLock()
+        # Encoded '"node_id":{...}' fragment per test, in tally_tests order, and
+        # the tests whose fragment must be re-encoded on the next encode()
+        self._fragments: Dict[str, bytes] = {}
+        self._fragments_codec: str = None
+        self._pending: Set[str] = set()
 
-    def to_json(self):
+    def mark_dirty(self, node_id: str) -> None:
+        """Flag a test as changed since the last call to encode()"""
+        with self.lock:
+            if node_id not in self._fragments:
+                self._fragments[node_id] = b""
+            self._pending.add(node_id)
+
+    def record_test_start(self) -> None:
+        with self.lock:
+            self.num_tests_running += 1
+
+    def record_test_finish(self, outcome: str) -> None:
+        """Move a test from running to finished, counting its outcome"""
+        with self.lock:
+            self.num_tests_running -= 1
+            self.num_tests_finished += 1
+            if outcome:
+                self.outcome_counts[outcome] = self.outcome_counts.get(outcome, 0) + 1
+
+    def record_worker_report(self, worker_id: str, node_id: str, when: str) -> None:
+        """Update the per-worker state from a report forwarded by pytest-xdist"""
+        with self.lock:
+            worker = self.workers.get(worker_id)
+            if worker is None:
+                worker = TallyWorker(worker_id=worker_id, timer=TallyCountTimer())
+                worker.timer.start()
+                self.workers[worker_id] = worker
+        if when == "setup":
+            worker.current_test = node_id
+        elif when == "teardown":
+            worker.current_test = None
+            worker.num_tests_have_run += 1
+
+    def encode(self, codec: TallyCodec, include_tests: bool = True) -> bytes:
+        """
+        Serialize the session with the given codec.
+
+        For json-family codecs only tests flagged with mark_dirty (or not yet
+        finished) are re-encoded; finished tests reuse their cached fragment, so
+        the cost of a snapshot is proportional to the number of changed tests
+        plus a concatenation of bytes.
+        """
+        if codec.binary or not include_tests:
+            # Called from the background flusher while hooks update the session
+            with self.lock:
+                data = self.to_json(include_tests=include_tests)
+            return codec.encode(data)
+
+        with self.lock:
+            if codec.name != self._fragments_codec or len(self._fragments) != len(
+                self.tally_tests
+            ):
+                self._fragments = dict.fromkeys(self.tally_tests, b"")
+                self._fragments_codec = codec.name
+                self._pending = set(self.tally_tests)
+
+            pending, self._pending = self._pending, set()
+            for node_id in pending:
+                tally_test = self.tally_tests[node_id]
+                self._fragments[node_id] = (
+                    codec.dumps(node_id) + b":" + codec.dumps(tally_test.to_json())
+                )
+                if not tally_test.is_finished():
+                    self._pending.add(node_id)
+
+            header = self.to_json(include_tests=False)
+            del header["tally_tests"]
+            raw = codec.dumps(header).rstrip()
+            return b"".join(
+                (
+                    raw[:-1],
+                    b',"tally_tests":{',
+                    b",".join(self._fragments.values()),
+                    b"}}",
+                )
+            )
+
+    def to_json(self, include_tests: bool = True):
         return {
             "session_started": self.session_started,
             "session_finished": self.session_finished,
             "session_duration": self.session_duration,
             "num_tests_to_run": self.num_tests_to_run,
             "num_tests_have_run": self.num_tests_have_run,
+            "num_tests_running": self.num_tests_running,
+            "num_tests_finished": self.num_tests_finished,
+            "outcome_counts": dict(self.outcome_counts),
             "timer": self.timer.to_json(),
             "lastline": self.lastline,
             "lastline_ansi": self.lastline_ansi,
-            "tally_tests": {k: v.to_json() for k, v in self.tally_tests.items()},
+            "tally_tests": (
+                {k: v.to_json() for k, v in self.tally_tests.items()}
+                if include_tests
+                else {}
+            ),
+            "tally_table": self.tally_table,
+            "workers": {k: v.to_json() for k, v in self.workers.items()},
+            "completion_fraction": self.completion_fraction,
+            "eta": self.eta,
+            "rates": self.rates.to_json() if self.rates is not None else None,
+            "slowest": self.slowest.to_json() if self.slowest is not None else None,
         }
 
 
@@ -68,28 +225,99 @@ class TallyTest:
     Class to hold pertinent info for each Pytest test executed.
     A test is made up of one or more test reports, usually one each
     corresponding to setup, call and teardown phases of the test.
+
+    Uses __slots__ rather than a per-instance __dict__, since there is one
+    instance per collected test (and suites can have hundreds of thousands).
+    Timing is kept as two time.perf_counter_ns stamps (test started / stopped)
+    plus pytest's own duration of each phase, rather than a timer object.
     """
 
+    __slots__ = (
+        "node_id",
+        "test_duration",
+        "test_outcome",
+        "reports",
+        "start_ns",
+        "stop_ns",
+        "setup_duration",
+        "call_duration",
+        "teardown_duration",
+    )
+
+    PHASES = ("setup", "call", "teardown")
+
     def __init__(
         self,
         node_id: str = None,
         test_duration: float = 0.0,
-        timer: TallyCountTimer = TallyCountTimer(),
         test_outcome: str = None,
-        reports: dict = {},
+        reports: dict = None,
+        start_ns: int = None,
+        stop_ns: int = None,
+        setup_duration: float = None,
+        call_duration: float = None,
+        teardown_duration: float = None,
     ) -> None:
         self.node_id = node_id
         self.test_duration = test_duration
-        self.timer = timer
         self.test_outcome = test_outcome
-        self.reports = reports
+        self.reports = reports if reports is not None else {}
+        self.start_ns = start_ns
+        self.stop_ns = stop_ns
+        self.setup_duration = setup_duration
+        self.call_duration = call_duration
+        self.teardown_duration = teardown_duration
+
+    def start(self) -> None:
+        self.start_ns = time.perf_counter_ns()
+        self.stop_ns = None
+
+    def stop(self) -> None:
+        self.stop_ns = time.perf_counter_ns()
+
+    @property
+    def running(self) -> bool:
+        return self.start_ns is not None and self.stop_ns is None
+
+    @property
+    def elapsed(self) -> float:
+        """Wall-clock seconds since the test started (until it stopped)"""
+        if self.start_ns is None:
+            return 0.0
+        stop_ns = self.stop_ns if self.stop_ns is not None else time.perf_counter_ns()
+        return (stop_ns - self.start_ns) / 1e9
+
+    @property
+    def phases(self) -> dict:
+        """pytest's duration of each setup/call/teardown phase that has run"""
+        return {
+            when: duration
+            for when in self.PHASES
+            if (duration := getattr(self, f"{when}_duration")) is not None
+        }
+
+    def record_phase(self, when: str, duration: float) -> None:
+        """Record pytest's duration of a setup/call/teardown phase"""
+        if when not in self.PHASES:
+            return
+        setattr(self, f"{when}_duration", duration)
+        self.test_duration = sum(self.phases.values())
+
+    def is_finished(self) -> bool:
+        # The teardown report is the last thing recorded for a test
+        return "teardown" in self.reports and self.stop_ns is not None
 
     def to_json(self):
         return {
             "node_id": self.node_id,
             "test_duration": self.test_duration,
             "test_outcome": self.test_outcome,
-            "timer": self.timer.to_json(),
+            "timer": {
+                "elapsed": self.elapsed,
+                "running": self.running,
+                "finished": self.stop_ns is not None,
+            },
+            "phases": self.phases,
             "reports": {k: v.to_json() for k, v in self.reports.items()},
         }
 
@@ -97,8 +325,11 @@ class TallyTest:
 class TallyReport:
     """
     Class to hold pertinent info for individual Pytest TestReport items.
+    The node_id is the same (interned) string object as its TallyTest's.
     """
 
+    __slots__ = ("node_id", "when", "outcome")
+
     def __init__(
         self,
         node_id: str = None,
@@ -115,3 +346,144 @@ class TallyReport:
             "when": self.when,
             "outcome": self.outcome,
         }
+
+
+class TallyWorker:
+    """
+    Class to hold pertinent info for a pytest-xdist worker, as seen from the
+    controller: the test it is running and how many tests it has finished.
+    """
+
+    __slots__ = ("worker_id", "num_tests_have_run", "current_test", "timer")
+
+    def __init__(
+        self,
+        worker_id: str = None,
+        num_tests_have_run: int = 0,
+        current_test: str = None,
+        timer: TallyCountTimer = None,
+    ) -> None:
+        self.worker_id = worker_id
+        self.num_tests_have_run = num_tests_have_run
+        self.current_test = current_test
+        self.timer = timer
+
+    def to_json(self):
+        elapsed = self.timer.elapsed if self.timer else 0.0
+        return {
+            "worker_id": self.worker_id,
+            "num_tests_have_run": self.num_tests_have_run,
+            "current_test": self.current_test,
+            "tests_per_sec": self.num_tests_have_run / elapsed if elapsed else 0.0,
+        }
+
+
+class TallyRates:
+    """
+    Class to estimate test throughput, overall and over a sliding window.
+
+    Finished tests are counted per outcome into a ring of one-second buckets,
+    one per second of the window; a bucket is reset when the ring comes back
+    around to it. Recording a test is O(1) and memory is fixed by the window
+    length, whatever the size of the suite. The buckets are published along
+    with the rates, so that clients can re-evaluate them as time goes by
+    (utils.current_rates).
+    """
+
+    OUTCOMES = ("passed", "failed", "error", "skipped", "xfailed", "xpassed")
+
+    __slots__ = ("window", "started", "finished", "num_finished", "_stamps", "_counts")
+
+    def __init__(self, window: int = 10) -> None:
+        self.window = window
+        self.started: float = None
+        self.finished: float = None
+        self.num_finished = 0
+        # Second (of time.time) each bucket holds counts for, and the
+        # per-outcome counts, plus a last column for tests with no outcome
+        self._stamps: List[int] = [-1] * window
+        self._counts: List[List[int]] = [
+            [0] * (len(self.OUTCOMES) + 1) for _ in range(window)
+        ]
+
+    def start(self) -> None:
+        self.started = time.time()
+
+    def stop(self) -> None:
+        self.finished = time.time()
+
+    def record(self, outcome: str) -> None:
+        second = int(time.time())
+        slot = second % self.window
+        counts = self._counts[slot]
+        if self._stamps[slot] != second:
+            self._stamps[slot] = second
+            counts[:] = [0] * len(counts)
+        try:
+            counts[self.OUTCOMES.index(outcome)] += 1
+        except ValueError:
+            counts[-1] += 1
+        self.num_finished += 1
+
+    def to_json(self):
+        return current_rates(
+            {
+                "window": self.window,
+                "started_at": self.started if self.started is not None else 0.0,
+                "finished_at": self.finished,
+                "num_finished": self.num_finished,
+                "outcomes": list(self.OUTCOMES),
+                "buckets": sorted(
+                    [stamp, list(counts)]
+                    for stamp, counts in zip(self._stamps, self._counts)
+                    if stamp >= 0
+                ),
+            }
+        )
+
+
+class TallySlowest:
+    """
+    Class to track the K slowest tests seen so far, as results come in.
+
+    Keeps one bounded min-heap of (duration, node_id) per tracked category:
+    the whole test ("test") and/or its "setup", "call" or "teardown" phase.
+    The fastest of the K entries is at the top of each heap, so recording a
+    test is O(log K) and publishing is a sort of K entries, however many
+    tests have run.
+    """
+
+    CATEGORIES = ("test", "setup", "call", "teardown")
+
+    __slots__ = ("k", "categories", "_heaps")
+
+    def __init__(self, k: int = 10, categories: Sequence[str] = ("test",)) -> None:
+        self.k = k
+        self.categories = tuple(categories)
+        self._heaps: Dict[str, List[Tuple[float, str]]] = {
+            category: [] for category in self.categories
+        }
+
+    def record(self, tally_test: "TallyTest") -> None:
+        for category, heap in self._heaps.items():
+            duration = (
+                tally_test.test_duration
+                if category == "test"
+                else getattr(tally_test, f"{category}_duration")
+            )
+            if duration is None:
+                continue
+            entry = (duration, tally_test.node_id)
+            if len(heap) < self.k:
+                heapq.heappush(heap, entry)
+            elif entry > heap[0]:
+                heapq.heapreplace(heap, entry)
+
+    def to_json(self):
+        return {
+            category: [
+                {"node_id": node_id, "duration": duration}
+                for duration, node_id in sorted(heap, reverse=True)
+            ]
+            for category, heap in self._heaps.items()
+        }
@@ -1,9 +1,31 @@
 import argparse
+import bisect
+import hashlib
 import json
 import logging
 import os
+import threading
+import time
+from collections import defaultdict, deque
+from itertools import chain, count, islice
+from pathlib import Path
 
-from flask import Flask, jsonify, render_template
+from flask import (
+    Flask,
+    Response,
+    jsonify,
+    render_template,
+    request,
+    stream_with_context,
+)
+
+from pytest_tally.utils import (
+    CachedJsonFileReader,
+    MmapStatusTable,
+    TallyDatabase,
+    TallySocketSubscriber,
+    socket_path_for,
+)
 
 app = Flask(__name__)
 
@@ -11,11 +33,53 @@ app = Flask(__name__)
 results = None
 fetch_rate = 10  # Default fetch rate in seconds
 
+# /events: how often streams check whether the tally data changed (a stat of
+# the data file; with --socket they are also woken by each pushed event), how
+# many deltas are kept for streams that fall behind, and how often an idle
+# stream sends a keep-alive comment
+EVENTS_POLL_TIME = 0.1
+EVENTS_BACKLOG = 256
+EVENTS_KEEPALIVE_TIME = 15.0
+
+# Paged /results: the query arguments and sort orders, and how many changed
+# tests an index update takes one at a time before it re-sorts instead (a
+# first read, a new session)
+RESULTS_QUERY_ARGS = ("offset", "limit", "outcome", "prefix", "sort")
+RESULTS_SORTS = ("duration", "node_id", "finish_order")
+INDEX_BULK_THRESHOLD = 64
+
 
 def read_json_file(file_path):
     global results
-    with open(file_path) as file:
-        results = json.load(file)
+    # With --socket the plugin pushes updates into the subscriber's local copy,
+    # so requests are served from memory instead of re-reading the data file;
+    # otherwise the file is only parsed again when it has changed
+    file_utils = app.config.get("TALLY_SUBSCRIBER") or get_reader(file_path)
+    results = file_utils.read_json()
+    if results.get("tally_table"):
+        table = get_table(results["tally_table"])
+        # The reader's cached dict is shared between requests; don't modify it
+        results = dict(results, tally_tests=table.tally_tests())
+    return results
+
+
+def get_reader(file_path) -> CachedJsonFileReader:
+    reader = app.config.get("TALLY_READER")
+    if reader is None or reader.file_path != Path(file_path):
+        reader = CachedJsonFileReader(file_path=Path(file_path))
+        app.config["TALLY_READER"] = reader
+    return reader
+
+
+def get_table(table_path) -> MmapStatusTable:
+    # The status table is mapped once and re-mapped when the plugin replaces
+    # it (a new session); a replaced table is left to be unmapped once no
+    # request uses it any more
+    table = app.config.get("TALLY_TABLE")
+    if table is None or table.file_path != Path(table_path) or table.is_stale():
+        table = MmapStatusTable(file_path=Path(table_path))
+        app.config["TALLY_TABLE"] = table
+    return table
 
 
 @app.route("/")
@@ -24,10 +88,426 @@ def index():
     return render_template("index.html", results=results, fetch_rate=fetch_rate)
 
 
+def results_version(file_path):
+    """
+    Identifies the current tally data without parsing it again: the subscriber's
+    sequence number with --socket, the generation of the data file's reader
+    otherwise. In 'mmap' mode the tests change in the status table without the
+    data file changing, so the table's digest is part of the version.
+    """
+    subscriber = app.config.get("TALLY_SUBSCRIBER")
+    if subscriber is not None:
+        return ("socket", subscriber.sequence)
+    reader = get_reader(file_path)
+    if reader.fingerprint() is None:
+        return None
+    generation, data = reader.read_versioned()
+    # A reader for another data file starts counting its generations again
+    version = (str(reader.file_path), generation)
+    table_path = data.get("tally_table")
+    if not table_path:
+        return version
+    return version + (get_table(table_path).digest(),)
+
+
+def get_results_body(file_path):
+    """
+    Return the encoded /results document and its ETag, re-encoding only when
+    the data has changed since the last request
+    """
+    # The version is taken before reading: if the data changes in between, the
+    # next request sees a different version and encodes it again
+    version = results_version(file_path)
+    cached = app.config.get("TALLY_RESULTS_CACHE")
+    if version is not None and cached is not None and cached[0] == version:
+        return cached[1], cached[2]
+
+    data = read_json_file(file_path)
+    body = jsonify(data).get_data()
+    etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+    if version is not None:
+        app.config["TALLY_RESULTS_CACHE"] = (version, body, etag)
+    return body, etag
+
+
 @app.route("/results")
 def get_results():
-    read_json_file(app.config["JSON_FILE_PATH"])
-    return jsonify(results)
+    """
+    The whole results document, or with any of offset, limit, outcome, prefix
+    or sort, one page of the tests answered from the feed's index, e.g.
+    /results?outcome=failed, /results?sort=duration&limit=50 or
+    /results?prefix=tests/api/&offset=100&limit=100
+    """
+    if any(arg in request.args for arg in RESULTS_QUERY_ARGS):
+        return query_results()
+    body, etag = get_results_body(app.config["JSON_FILE_PATH"])
+    return conditional_response(body, etag)
+
+
+def query_results():
+    offset = request.args.get("offset", 0, type=int)
+    limit = request.args.get("limit", type=int)
+    sort = request.args.get("sort", "node_id")
+    if sort not in RESULTS_SORTS:
+        error = f"Unknown sort '{sort}'; expected one of {', '.join(RESULTS_SORTS)}"
+        return jsonify({"error": error}), 400
+    if offset < 0 or (limit is not None and limit < 0):
+        return jsonify({"error": "offset and limit must not be negative"}), 400
+    feed = get_feed()
+    feed.poll()
+    with feed.condition:
+        total, tests = feed.index.query(
+            sort=sort,
+            outcome=request.args.get("outcome"),
+            prefix=request.args.get("prefix"),
+            offset=offset,
+            limit=limit,
+        )
+        page = {
+            "session": feed.header,
+            "total": total,
+            "offset": offset,
+            "limit": limit,
+            "tests": tests,
+        }
+        body = jsonify(page).get_data()
+    return conditional_response(body, hashlib.blake2b(body, digest_size=16).hexdigest())
+
+
+def conditional_response(body, etag):
+    response = Response(body, mimetype="application/json")
+    # Strong ETag from the content; no-cache makes browsers revalidate every
+    # poll, which an unchanged document answers with an empty 304
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+class ResultsIndex:
+    """
+    The tests of the tally data, kept in node ID, duration and finish order
+    and grouped by outcome, for paged /results queries
+
+    Updated with only the tests that changed: a handful are inserted with
+    bisect, larger batches are appended and re-sorted (cheap on the already
+    sorted bulk). Running tests come last by duration (they have none yet)
+    and first in finish order, which is newest first. Outcomes are lower
+    case, with 'running' for running tests. A filter is a set of node IDs
+    (an outcome's tests, a prefix's range of the node ID order) that one pass
+    over the requested order picks the page from.
+    """
+
+    def __init__(self):
+        self.reset({})
+
+    def reset(self, tests):
+        self.tests = {}
+        self.node_ids = []
+        self.durations = []
+        self.finished = {}
+        self.running = {}
+        self.outcomes = defaultdict(set)
+        self.counter = count()
+        self.update(tests)
+
+    def update(self, changed):
+        bulk = len(changed) > INDEX_BULK_THRESHOLD
+        new_node_ids, new_durations = [], []
+        for node_id, test in changed.items():
+            old = self.tests.get(node_id)
+            if old is None:
+                new_node_ids.append(node_id)
+            else:
+                self.remove(node_id, old)
+            self.tests[node_id] = test
+            self.outcomes[self.outcome(test)].add(node_id)
+            if test["timer"]["running"]:
+                self.running[node_id] = next(self.counter)
+                continue
+            self.finished[node_id] = next(self.counter)
+            key = (-(test["test_duration"] or 0), node_id)
+            if bulk:
+                new_durations.append(key)
+            else:
+                bisect.insort(self.durations, key)
+        if bulk:
+            self.node_ids.extend(new_node_ids)
+            self.node_ids.sort()
+            self.durations.extend(new_durations)
+            self.durations.sort()
+        else:
+            for node_id in new_node_ids:
+                bisect.insort(self.node_ids, node_id)
+
+    def remove(self, node_id, test):
+        self.outcomes[self.outcome(test)].discard(node_id)
+        if test["timer"]["running"]:
+            del self.running[node_id]
+            return
+        # A test that finishes again (e.g. rerun) moves to the end of the order
+        del self.finished[node_id]
+        key = (-(test["test_duration"] or 0), node_id)
+        i = bisect.bisect_left(self.durations, key)
+        if i < len(self.durations) and self.durations[i] == key:
+            del self.durations[i]
+
+    @staticmethod
+    def outcome(test):
+        if test["timer"]["running"]:
+            return "running"
+        return (test["test_outcome"] or "").lower()
+
+    def query(self, sort="node_id", outcome=None, prefix=None, offset=0, limit=None):
+        """Return (number of matching tests, the tests of the requested page)"""
+        stop = None if limit is None else offset + limit
+        keep = self.outcomes.get(outcome.lower(), set()) if outcome else None
+        node_ids = self.node_ids
+        if prefix:
+            # The prefix's node IDs are a contiguous range of the sorted list
+            lo = bisect.bisect_left(self.node_ids, prefix)
+            hi = bisect.bisect_left(self.node_ids, prefix + "\U0010ffff")
+            node_ids = self.node_ids[lo:hi]
+            if keep is not None:
+                keep = keep.intersection(node_ids)
+            elif sort != "node_id":
+                keep = set(node_ids)
+        if keep is not None and len(keep) * 8 < len(self.tests):
+            # Few matches: sorting them beats a pass over every test
+            order = sorted(keep, key=self.sort_key(sort))
+        elif sort == "node_id":
+            order = node_ids
+            if keep is not None:
+                order = [node_id for node_id in order if node_id in keep]
+        elif sort == "duration":
+            if keep is None:
+                return len(self.tests), self.page(
+                    chain((node_id for _, node_id in self.durations), self.running),
+                    offset,
+                    stop,
+                )
+            order = [node_id for _, node_id in self.durations if node_id in keep]
+            order.extend(node_id for node_id in self.running if node_id in keep)
+        else:
+            order = chain(reversed(self.running), reversed(self.finished))
+            if keep is None:
+                return len(self.tests), self.page(order, offset, stop)
+            order = [node_id for node_id in order if node_id in keep]
+        return len(order), self.page(order, offset, stop)
+
+    def page(self, order, offset, stop):
+        return [self.tests[node_id] for node_id in islice(order, offset, stop)]
+
+    def sort_key(self, sort):
+        # The position of a test in the requested order, without going
+        # through the whole order
+        if sort == "node_id":
+            return None
+        if sort == "duration":
+
+            def key(node_id):
+                if node_id in self.running:
+                    return (1, self.running[node_id])
+                return (0, -(self.tests[node_id]["test_duration"] or 0), node_id)
+
+        else:
+
+            def key(node_id):
+                if node_id in self.running:
+                    return (0, -self.running[node_id])
+                return (1, -self.finished[node_id])
+
+        return key
+
+
+class ResultsFeed:
+    """
+    Turns successive versions of the tally data into deltas for /events
+
+    Each version is diffed against the previous one once, however many
+    streams are open: the delta holds the session header (counters, progress,
+    rates, ...) and only the tests that were added or changed. Deltas are kept
+    in a bounded backlog with increasing sequence numbers; a stream that is
+    further behind than the backlog, or that missed a reset (tests gone, i.e.
+    a new session), is sent a fresh snapshot instead. The same changes keep
+    the ResultsIndex that answers paged /results queries up to date.
+
+    Streams opened with tests=0 get the session header only, in both the
+    snapshot and the deltas, and use the deltas as a signal to re-query.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.condition = threading.Condition()
+        self.version = None
+        self.results = {}
+        self.header = {}
+        self.index = ResultsIndex()
+        self.seq = 0
+        self.reset_seq = 0
+        self.deltas = deque(maxlen=EVENTS_BACKLOG)
+        self.polled_at = 0.0
+
+    def notify(self):
+        with self.condition:
+            self.condition.notify_all()
+
+    def wait(self, timeout):
+        with self.condition:
+            self.condition.wait(timeout)
+
+    def poll(self):
+        """Read the tally data if its version changed, and record the delta"""
+        with self.condition:
+            version = results_version(self.file_path)
+            if version is not None and version == self.version:
+                return
+            # Without a version (no data file yet) every poll reads the data;
+            # don't let several streams do so more often than one would
+            now = time.monotonic()
+            if version is None and now - self.polled_at < EVENTS_POLL_TIME:
+                return
+            self.polled_at = now
+            data = read_json_file(self.file_path)
+            self.version = version
+            tests = data.get("tally_tests") or {}
+            old_tests = self.results.get("tally_tests") or {}
+            header = {k: v for k, v in data.items() if k != "tally_tests"}
+            old_header = self.header
+            self.results = data
+            self.header = header
+            # A first read (or a new session) is sent as snapshots rather than
+            # as a delta of every test
+            if not old_tests or any(node_id not in tests for node_id in old_tests):
+                self.seq += 1
+                self.reset_seq = self.seq
+                self.deltas.clear()
+                self.index.reset(tests)
+                return
+            changed = {
+                node_id: test
+                for node_id, test in tests.items()
+                if old_tests.get(node_id) != test
+            }
+            self.index.update(changed)
+            if changed or header != old_header:
+                self.seq += 1
+                self.deltas.append(
+                    (
+                        self.seq,
+                        encode_event("delta", {"session": header, "tests": changed}),
+                        encode_event("delta", {"session": header, "tests": {}}),
+                    )
+                )
+
+    def snapshot(self, tests=True):
+        return encode_event("snapshot", self.results if tests else self.header)
+
+    def events_since(self, seq, tests=True):
+        """Return (events to send, new sequence number) for a stream at seq"""
+        with self.condition:
+            if seq == self.seq:
+                return [], seq
+            oldest = self.deltas[0][0] if self.deltas else self.seq + 1
+            if seq < self.reset_seq or seq < oldest - 1:
+                return [self.snapshot(tests)], self.seq
+            return [
+                delta if tests else header_only
+                for s, delta, header_only in self.deltas
+                if s > seq
+            ], self.seq
+
+
+def encode_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+def get_feed() -> ResultsFeed:
+    feed = app.config.get("TALLY_FEED")
+    if feed is None:
+        feed = ResultsFeed(app.config["JSON_FILE_PATH"])
+        app.config["TALLY_FEED"] = feed
+    return feed
+
+
+def notify_feed():
+    # Called by the socket subscriber for each pushed event
+    feed = app.config.get("TALLY_FEED")
+    if feed is not None:
+        feed.notify()
+
+
+@app.route("/events")
+def stream_events():
+    """
+    Server-Sent Events: a 'snapshot' event with the whole results, then a
+    'delta' event with the session header and the added/changed tests each
+    time the tally data changes; with tests=0, the session header only
+    """
+    feed = get_feed()
+    tests = request.args.get("tests", 1, type=int) != 0
+
+    def generate():
+        feed.poll()
+        with feed.condition:
+            seq, snapshot = feed.seq, feed.snapshot(tests)
+        yield snapshot
+        last_sent = time.monotonic()
+        while True:
+            feed.wait(EVENTS_POLL_TIME)
+            feed.poll()
+            events, seq = feed.events_since(seq, tests)
+            if events:
+                yield "".join(events)
+                last_sent = time.monotonic()
+            elif time.monotonic() - last_sent > EVENTS_KEEPALIVE_TIME:
+                yield ": keep-alive\n\n"
+                last_sent = time.monotonic()
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def get_database():
+    # The plugin's --tally-db database lives next to the data file; it is opened
+    # once and shared by all requests (WAL lets it be read while pytest writes)
+    database = app.config.get("TALLY_DATABASE")
+    if database is None:
+        database = TallyDatabase(
+            file_path=Path(app.config["JSON_FILE_PATH"]).with_suffix(".db")
+        )
+        app.config["TALLY_DATABASE"] = database
+    return database
+
+
+@app.route("/query")
+def query_tests():
+    """
+    Indexed query of the --tally-db database, e.g. /query?outcome=failed,
+    /query?sort=duration&limit=50 or /query?prefix=tests/api/
+    """
+    try:
+        database = get_database()
+    except FileNotFoundError as e:
+        return jsonify({"error": str(e)}), 404
+    session_id = request.args.get("session_id", type=int)
+    session = (
+        database.latest_session() if session_id is None else {"session_id": session_id}
+    )
+    try:
+        tests = database.tests(
+            session_id=session.get("session_id"),
+            outcome=request.args.get("outcome"),
+            prefix=request.args.get("prefix"),
+            sort=request.args.get("sort", "node_id"),
+            limit=request.args.get("limit", type=int),
+            offset=request.args.get("offset", 0, type=int),
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"session": session, "tests": tests})
 
 
 def parse_arguments():
@@ -106,10 +586,22 @@ def main():
         default=2000,
         help="fetch rate (in ms) - effectively the update rate of the web app",
     )
+    parser.add_argument(
+        "--socket",
+        action="store_true",
+        help="receive pushed updates from the plugin's --tally-socket",
+    )
     args = parser.parse_args()
 
     # Configure and run the Flask app
     app.config["JSON_FILE_PATH"] = args.json_file
+    if args.socket:
+        subscriber = TallySocketSubscriber(
+            socket_path=socket_path_for(Path(args.json_file)),
+            on_update=notify_feed,
+        )
+        subscriber.start()
+        app.config["TALLY_SUBSCRIBER"] = subscriber
     fetch_rate = args.fetch_rate
     print(fetch_rate)  # Keeping Flake8 happy for now
     configure_logging(args.log_level)
@@ -1,8 +1,11 @@
 import os
+import sys
 import time
 from argparse import ArgumentParser, Namespace
+from itertools import islice
 from pathlib import Path
 from threading import Event, Thread
+from typing import Callable, Dict, Tuple
 
 from blessed import Terminal
 from quantiphy import Quantity, render
@@ -14,10 +17,32 @@ from rich.progress import BarColumn, Progress, TaskProgressColumn, TextColumn
 from rich.status import Status
 from rich.table import Table
 from rich.text import Text
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
 
 from pytest_tally import __version__
 from pytest_tally.plugin import DEFAULT_FILE, TallySession
-from pytest_tally.utils import LocakbleJsonFileUtils, clear_file
+from pytest_tally.utils import (
+    CachedJsonFileReader,
+    MmapStatusTable,
+    TallySocketSubscriber,
+    clear_file,
+    format_eta,
+    format_rates,
+    socket_path_for,
+)
+
+DEFAULT_FPS = 10
+# Longest wait between frames without a change notification; covers updates
+# that raise none, such as in-place writes to an mmap status table
+IDLE_REFRESH_TIME = 1.0
+# Terminal lines taken by everything but the table's rows: the table's
+# borders, header and caption, the progress panel, and any other panel's
+# borders. Finished rows' cells are cached up to ROW_CACHE_SIZE entries.
+TABLE_CHROME_LINES = 5
+PROGRESS_PANEL_LINES = 3
+PANEL_CHROME_LINES = 2
+ROW_CACHE_SIZE = 4096
 
 OUTCOME_STYLES = {
     "passed": "green",
@@ -45,19 +70,57 @@ class CmdLineOptions:
         self.max_rows = args.max_rows if hasattr(args, "max_rows") else 0
         self.lines = args.lines
         self.persist = args.persist if hasattr(args, "persist") else False
+        self.socket = args.socket if hasattr(args, "socket") else False
+        self.fps = args.fps if getattr(args, "fps", None) else DEFAULT_FPS
+
+
+class FileChangeEventHandler(FileSystemEventHandler):
+    """Calls back when the data file is rewritten in place or replaced"""
+
+    def __init__(self, file_path: Path, callback: Callable[[], None]) -> None:
+        self.file_path = file_path.resolve()
+        self.callback = callback
+
+    def on_any_event(self, event) -> None:
+        if event.is_directory:
+            return
+        # Atomic publishes show up as a move of the temp file onto the data file
+        for path in (event.src_path, getattr(event, "dest_path", "")):
+            if path and Path(path) == self.file_path:
+                self.callback()
+                return
 
 
 class Stats:
-    def __init__(self, options: CmdLineOptions) -> None:
+    def __init__(
+        self, options: CmdLineOptions, on_update: Callable[[], None] = None
+    ) -> None:
         self.options: CmdLineOptions = options
         self.tot_num_to_run: int = 0
         self.num_running: int = 0
         self.num_finished: int = 0
         self.testing_started: bool = False
         self.testing_complete: bool = False
+        self.completion_fraction: float = None
+        self.eta: float = None
+        self.rates: dict = None
+        self.slowest: dict = None
+        self.status_table: MmapStatusTable = None
+        self.subscriber: TallySocketSubscriber = None
+        self.reader = CachedJsonFileReader(file_path=self.options.filename)
+        self.test_session_data: TallySession = None
+        self._session_json: dict = None
+        if self.options.socket:
+            # Updates are pushed by the plugin (--tally-socket) instead of being
+            # re-read from the data file
+            self.subscriber = TallySocketSubscriber(
+                socket_path=socket_path_for(self.options.filename),
+                on_update=on_update,
+            )
+            self.subscriber.start()
 
     def _get_test_session_data(self, init: bool = False) -> TallySession:
-        lock_utils = LocakbleJsonFileUtils(file_path=self.options.filename)
+        file_utils = self.subscriber or self.reader
         if init:
             return TallySession(
                 session_started=False,
@@ -71,7 +134,11 @@ class Stats:
                 tally_tests={},
                 config=None,
             )
-        j = lock_utils.read_json()
+        j = file_utils.read_json()
+        if j is self._session_json:
+            # Data file unchanged since the last read
+            return self.test_session_data
+        self._session_json = j
         if j:
             return TallySession(**j, config=None)
 
@@ -80,29 +147,53 @@ class Stats:
         self.test_session_data = self._get_test_session_data(init=init)
         if self.test_session_data:
             self.tot_num_to_run = self.test_session_data.num_tests_to_run
-            self.num_running = len(
-                [
-                    test
-                    for test in self.test_session_data.tally_tests.values()
-                    if test["timer"]["running"]
-                ]
-            )
-            self.num_finished = len(
-                [
-                    test
-                    for test in self.test_session_data.tally_tests.values()
-                    if test["timer"]["finished"]
-                ]
-            )
-            # self.testing_started = self.num_running > 0
+            if self.test_session_data.tally_table:
+                self._update_from_status_table(Path(self.test_session_data.tally_table))
+            else:
+                self._update_from_counters()
             self.testing_started = self.test_session_data.session_started
             self.testing_complete = self.test_session_data.session_finished
+            self.completion_fraction = self.test_session_data.completion_fraction
+            self.eta = self.test_session_data.eta
+            self.rates = self.test_session_data.rates
+            self.slowest = self.test_session_data.slowest
+
+    def _update_from_counters(self) -> None:
+        # The plugin keeps running/finished counts up to date itself, so there
+        # is no need to walk every test
+        self.num_running = self.test_session_data.num_tests_running
+        self.num_finished = self.test_session_data.num_tests_finished
+
+    def _update_from_status_table(self, table_path: Path) -> None:
+        # In 'mmap' mode the data file only has session-level info; per-test
+        # status is read from the memory-mapped table it points to
+        if (
+            self.status_table is None
+            or self.status_table.file_path != table_path
+            or self.status_table.is_stale()
+        ):
+            if self.status_table is not None:
+                self.status_table.close()
+            self.status_table = MmapStatusTable(file_path=table_path)
+        counts = self.status_table.counts()
+        self.num_running = counts["running"]
+        self.num_finished = counts["finished"]
+        self.test_session_data.tally_tests = self.status_table.tally_tests()
 
 
 class TallyApp:
     def __init__(self, args: Namespace):
         self.options = CmdLineOptions(args)
-        self.stats = Stats(self.options)
+        # Set whenever the plugin has published something new
+        self.changed = Event()
+        self.changed.set()
+        self.stats = Stats(self.options, on_update=self.changed.set)
+        self.file_observer: Observer = None
+        # Rows scrolled up from the newest test (0 follows the tail), the
+        # number of rows last shown, and the cells of finished tests' rows
+        self.scroll_offset = 0
+        self.page_size = 1
+        self.row_cache: Dict[tuple, Tuple[Text, str, Text]] = {}
 
         self.console = Console()
         self.term = Terminal()
@@ -127,80 +218,170 @@ class TallyApp:
             with self.term.cbreak():
                 if self.event.is_set() and not self.options.persist:
                     os._exit(0)
-                key = self.term.inkey(timeout=1).lower()
-                if key and key == "q":
+                key = self.term.inkey(timeout=1)
+                if key and key.lower() == "q":
                     os._exit(0)
+                if self.scroll(key):
+                    self.changed.set()
+
+    def scroll(self, key) -> bool:
+        """Move the table window for a scrolling key; False for any other key"""
+        if key.name == "KEY_UP" or key == "k":
+            self.scroll_offset += 1
+        elif key.name == "KEY_DOWN" or key == "j":
+            self.scroll_offset -= 1
+        elif key.name == "KEY_PGUP":
+            self.scroll_offset += self.page_size
+        elif key.name == "KEY_PGDOWN":
+            self.scroll_offset -= self.page_size
+        elif key.name == "KEY_HOME" or key == "g":
+            # Clamped to the first test when the next frame is built
+            self.scroll_offset = sys.maxsize
+        elif key.name == "KEY_END" or key == "G":
+            self.scroll_offset = 0
+        else:
+            return False
+        self.scroll_offset = max(self.scroll_offset, 0)
+        return True
+
+    def slowest_panel(self) -> Panel:
+        # The plugin keeps the top-K per category (--tally-top-slowest), so
+        # there is nothing to sort here
+        if not self.stats.slowest:
+            return None
+        table = Table(expand=True, box=None, show_header=False)
+        show_category = len(self.stats.slowest) > 1
+        if show_category:
+            table.add_column("Category", style="dim")
+        table.add_column("Test")
+        table.add_column("Duration", justify="right")
+        for category, entries in self.stats.slowest.items():
+            for entry in entries:
+                row = [
+                    Text(entry["node_id"], style="bold blue"),
+                    render(Duration(str(entry["duration"])), "s"),
+                ]
+                table.add_row(*([category] + row if show_category else row))
+        return Panel(table, title="Slowest so far", title_align="left")
+
+    def visible_rows(self) -> int:
+        """Number of table rows that fit in the terminal below the other panels"""
+        reserved = TABLE_CHROME_LINES + PROGRESS_PANEL_LINES
+        if self.stats.slowest:
+            reserved += PANEL_CHROME_LINES + sum(
+                len(entries) for entries in self.stats.slowest.values()
+            )
+        if self.stats.testing_complete:
+            reserved += PANEL_CHROME_LINES + 1
+        rows = (self.console.size.height - reserved) // (2 if self.options.lines else 1)
+        rows = max(rows, 1)
+        return min(rows, self.options.max_rows) if self.options.max_rows else rows
+
+    def build_table(self, tally_tests: dict, stylize_last_line: bool) -> Table:
+        num_tests = len(tally_tests)
+        num_rows = min(self.visible_rows(), num_tests)
+        self.page_size = num_rows
+
+        # scroll_offset counts rows up from the newest test (0 follows the
+        # tail); only the window itself is walked, from the end of the dict
+        self.scroll_offset = offset = min(self.scroll_offset, num_tests - num_rows)
+        window = list(islice(reversed(tally_tests.values()), offset, offset + num_rows))
+        window.reverse()
+
+        table = Table(
+            highlight=True,
+            expand=True,
+            show_lines=self.options.lines,
+            box=rounded,
+            caption=(
+                f"{num_tests - offset - num_rows + 1}-{num_tests - offset} of"
+                f" {num_tests} (Up/Down, PgUp/PgDn, Home/End to scroll)"
+                if num_rows < num_tests
+                else None
+            ),
+        )
+        table.add_column("Test", no_wrap=True, overflow="ellipsis")
+        table.add_column("Duration", no_wrap=True)
+        table.add_column("Outcome", no_wrap=True)
+
+        for i, test in enumerate(window):
+            # Show spinny progress icon for last line of table while session
+            # running (and the table is following the newest tests)
+            if stylize_last_line and offset == 0 and i == len(window) - 1:
+                name, _, outcome = self.build_row(test)
+                table.add_row(Status(name), Status(""), outcome)
+            else:
+                table.add_row(*self.row_cells(test))
+        return table
+
+    def row_cells(self, test: dict) -> Tuple[Text, str, Text]:
+        # A finished test no longer changes, so its cells are built once and
+        # reused by every later frame it is visible in
+        if not test["timer"]["finished"]:
+            return self.build_row(test)
+        key = (test["node_id"], test["test_outcome"], test["test_duration"])
+        cells = self.row_cache.get(key)
+        if cells is None:
+            if len(self.row_cache) >= ROW_CACHE_SIZE:
+                self.row_cache.clear()
+            cells = self.row_cache[key] = self.build_row(test)
+        return cells
+
+    @staticmethod
+    def build_row(test: dict) -> Tuple[Text, str, Text]:
+        name = Text(test["node_id"], style="bold blue")
+        duration = (
+            Duration(str(test["test_duration"])) if test["test_duration"] else 0.0
+        )
+        outcome = Text(test["test_outcome"]) if test["test_outcome"] else Text("---")
+        for key, value in OUTCOME_STYLES.items():
+            if key in outcome.plain.lower():
+                outcome.stylize(value)
+                name.stylize(value)
+                break
+        else:
+            outcome.stylize("bold blue")
+            name.stylize("bold blue")
+        return name, render(duration, "s"), outcome
 
     def main_panel_group(self, stylize_last_line: bool = True) -> Group:
-        # Main table (no panel container; it stands alone, looks better that way);
-        # it's ok to loop over a Rich Table because it just redraws each iteration;
-        # in fact, the Table class does not even have an update() method.
-        self.table = Table(
-            highlight=True, expand=True, show_lines=self.options.lines, box=rounded
-        )
-        self.table.add_column("Test")
-        self.table.add_column("Duration")
-        self.table.add_column("Outcome")
+        # Main table (no panel container; it stands alone, looks better that way).
+        # Only the rows that fit the terminal are built, so the cost of a frame
+        # does not grow with the number of tests.
+        tally_tests = getattr(self.stats.test_session_data, "tally_tests", None)
 
         # Wait till plugin.py starts to populate results file
-        if (
-            not hasattr(self.stats.test_session_data, "tally_tests")
-            or not self.stats.test_session_data.tally_tests
-        ):
+        if not tally_tests:
             return self.panel_progress
 
-        # Accommodate optional execution flag for max rows to display ("-x"),
-        num_table_rows = (
-            len(self.stats.test_session_data.tally_tests)
-            if self.options.max_rows == 0
-            else self.options.max_rows
-        )
-        tally_tests = list(self.stats.test_session_data.tally_tests.values())[
-            -num_table_rows:
-        ]
-
-        # For each test result, add a row to the table with test info
-        for _, test in enumerate(tally_tests):
-            name = Text(test["node_id"], style="bold blue")
-            duration = (
-                Duration(str(test["test_duration"])) if test["test_duration"] else 0.0
-            )
-            outcome = (
-                Text(test["test_outcome"]) if test["test_outcome"] else Text("---")
-            )
-            for key, value in OUTCOME_STYLES.items():
-                if key in outcome.plain.lower():
-                    outcome.stylize(value)
-                    name.stylize(value)
-                    break
-            else:
-                outcome.stylize("bold blue")
-                name.stylize("bold blue")
-
-            # Show spinny progress icon for last line of table while session running
-            if stylize_last_line:
-                if _ == len(tally_tests) - 1:
-                    name = Status(name)
-                    self.table.add_row(name, Status(""), outcome)
-                else:
-                    self.table.add_row(name, render(duration, "s"), outcome)
-            else:
-                self.table.add_row(name, render(duration, "s"), outcome)
-
-        self.stats.update_stats()
+        self.table = self.build_table(tally_tests, stylize_last_line)
 
         if self.stats.testing_started:
+            # Throughput (sliding window, overall and per outcome) under the bar
+            rates = format_rates(self.stats.rates)
+            self.panel_progress.subtitle = Text(rates) if rates else None
             if not self.stats.testing_complete:
                 # self.progress.tasks[
                 #     self.task_id
                 # ].description = "Testing In Progress..."
                 if not self.progress.tasks[self.task_id].started:
                     self.progress.start_task(self.task_id)
+                # With a duration history the bar is weighted by expected test
+                # time rather than by test count
+                if self.stats.completion_fraction is not None:
+                    total, completed = 1.0, self.stats.completion_fraction
+                else:
+                    total, completed = (
+                        self.stats.tot_num_to_run,
+                        self.stats.num_finished,
+                    )
                 self.progress.update(
                     self.task_id,
-                    total=self.stats.tot_num_to_run,
-                    completed=self.stats.num_finished,
-                    description="Testing In Progress...",
+                    total=total,
+                    completed=completed,
+                    description=" ".join(
+                        ("Testing In Progress...", format_eta(self.stats.eta))
+                    ).rstrip(),
                     refresh=True,
                 )
             else:  # testing complete
@@ -211,22 +392,24 @@ class TallyApp:
                     description="Testing Complete",
                     refresh=True,
                 )
-                time.sleep(1)
                 self.progress.stop_task(self.task_id)
 
         # Rederable group - members depend on what phase of test session we are in:
         # Before tests start, only show progress bar
         # After tests start, show progress bar and table
         # After tests finish, show progress bar, table, and last line of test output
+        slowest_panel = self.slowest_panel()
+
         @group()
         def get_panels(finished: bool = False):
             if not self.stats.testing_started:
                 yield self.panel_progress
             elif self.stats.testing_started and not self.stats.testing_complete:
                 yield self.table
+                if slowest_panel:
+                    yield slowest_panel
                 yield self.panel_progress
             elif self.stats.testing_started and self.stats.testing_complete:
-                self.stats.update_stats()
                 if self.stats.test_session_data and hasattr(
                     self.stats.test_session_data, "lastline_ansi"
                 ):
@@ -235,31 +418,59 @@ class TallyApp:
                     last_line_ansi = ""
                 last_line = Text.from_ansi(last_line_ansi)
                 yield self.table
+                if slowest_panel:
+                    yield slowest_panel
                 yield self.panel_progress
                 yield Panel(last_line)
 
         return get_panels()
 
+    def start_file_monitoring(self) -> None:
+        # With --socket the subscriber signals changes itself
+        if self.stats.subscriber is not None:
+            return
+        self.file_observer = Observer()
+        self.file_observer.schedule(
+            FileChangeEventHandler(self.options.filename, self.changed.set),
+            str(self.options.filename.resolve().parent),
+            recursive=False,
+        )
+        self.file_observer.start()
+
+    def stop_file_monitoring(self) -> None:
+        if self.file_observer is not None:
+            self.file_observer.stop()
+            self.file_observer.join()
+            self.file_observer = None
+
     def rich_client(self) -> None:
-        # Put thread into a loop that proceseses pytest results until test
-        # session is complete
+        # Redraw only when the plugin has published something new, and at most
+        # options.fps times a second; changes arriving in between are coalesced
+        # into the next frame. Live's own refresh thread is off, so the
+        # dashboard sleeps between updates.
         self.stats.update_stats(init=True)
+        self.start_file_monitoring()
+        frame_time = 1.0 / self.options.fps
 
         with Live(
             self.main_panel_group(),
             vertical_overflow="visible",
+            auto_refresh=False,
         ) as live:
             while not self.stats.testing_complete:
-                live.update(self.main_panel_group())
+                self.changed.wait(IDLE_REFRESH_TIME)
+                self.changed.clear()
+                frame_start = time.monotonic()
                 self.stats.update_stats()
+                live.update(self.main_panel_group(), refresh=True)
+                time.sleep(max(0.0, frame_time - (time.monotonic() - frame_start)))
 
             # Don't show spinny progress icon since tests are now finished,
             # otherwise it will appear frozen in time
-            live.update(self.main_panel_group(stylize_last_line=False))
+            live.update(self.main_panel_group(stylize_last_line=False), refresh=True)
 
-        # Make a final query of the stats to ensure latest results
         # Set the event, to signal to the kb_input thread to exit
-        self.stats.update_stats()
+        self.stop_file_monitoring()
         self.event.set()
 
 
@@ -288,6 +499,21 @@ def main():
         default=0,
         help="ma[x] number of rows to display (default: 0 [no limit])",
     )
+    parser.add_argument(
+        "-r",
+        "--fps",
+        action="store",
+        type=float,
+        default=DEFAULT_FPS,
+        help=f"max [r]efresh rate, in frames per second (default: {DEFAULT_FPS})",
+    )
+    parser.add_argument(
+        "-s",
+        "--socket",
+        action="store_true",
+        default=False,
+        help="receive pushed updates from the plugin's --tally-socket (default: False)",
+    )
     parser.add_argument(
         "-f",
         "--file-path",
@@ -2,12 +2,15 @@ import json
 import logging
 import shutil
 import sys
+import threading
 import tkinter as tk
 import tkinter.font as tkfont
+from bisect import bisect_left
 from dataclasses import dataclass
 from pathlib import Path
 from tkinter import filedialog
-from tkinter.ttk import Notebook, Progressbar
+from tkinter.ttk import Notebook, Progressbar, Style, Treeview
+from typing import Dict, List, Tuple
 
 from quantiphy import Quantity, render
 from watchdog.events import FileSystemEventHandler, LoggingEventHandler
@@ -15,12 +18,22 @@ from watchdog.observers import Observer
 
 from pytest_tally import __version__
 from pytest_tally.plugin import DEFAULT_FILE, TallySession
-from pytest_tally.utils import LocakbleJsonFileUtils, clear_file
+from pytest_tally.utils import (
+    CachedJsonFileReader,
+    MmapStatusTable,
+    TallySocketSubscriber,
+    clear_file,
+    format_eta,
+    format_rates,
+    socket_path_for,
+)
 
 TERM_SIZE = shutil.get_terminal_size()
 APP_HEIGHT = 700
 APP_WIDTH = 1020
 APP_TITLE = f"Pytest Tally v{__version__}"
+CHAR_WIDTH = 10  # Approximate pixels per character of the table font
+UI_REFRESH_TIME_MS = 100  # Shortest interval between two updates of the widgets
 
 
 @dataclass
@@ -36,6 +49,15 @@ TABLE_COLUMNS = [
 ]
 
 
+@dataclass
+class Snapshot:
+    """Parsed session data handed from the parse worker to the Tk main loop"""
+
+    test_session_data: TallySession
+    num_finished: int
+    tot_num_to_run: int
+
+
 class Duration(Quantity):
     units = "s"
     prec = 2
@@ -48,11 +70,18 @@ class Stats:
         self.num_finished: int = 0
         self.testing_started: bool = False
         self.testing_complete: bool = False
+        self.status_table: MmapStatusTable = None
+        self.subscriber: TallySocketSubscriber = None
+        self.reader: CachedJsonFileReader = None
+        self.test_session_data: TallySession = None
+        self._session_json: dict = None
 
     def _get_test_session_data(
         self, file_path: Path, init: bool = False
     ) -> TallySession:
-        lock_utils = LocakbleJsonFileUtils(file_path=file_path)
+        if self.reader is None or self.reader.file_path != file_path:
+            self.reader = CachedJsonFileReader(file_path=file_path)
+        file_utils = self.subscriber or self.reader
         if init:
             return TallySession(
                 session_started=False,
@@ -66,7 +95,11 @@ class Stats:
                 tally_tests={},
                 config=None,
             )
-        j = lock_utils.read_json()
+        j = file_utils.read_json()
+        if j is self._session_json:
+            # Data file unchanged since the last read
+            return self.test_session_data
+        self._session_json = j
         if j:
             return TallySession(**j, config=None)
 
@@ -77,31 +110,51 @@ class Stats:
         )
         if self.test_session_data:
             self.tot_num_to_run = self.test_session_data.num_tests_to_run
-            self.num_running = len(
-                [
-                    test
-                    for test in self.test_session_data.tally_tests.values()
-                    if test["timer"]["running"]
-                ]
-            )
-            self.num_finished = len(
-                [
-                    test
-                    for test in self.test_session_data.tally_tests.values()
-                    if test["timer"]["finished"]
-                ]
-            )
+            if self.test_session_data.tally_table:
+                self._update_from_status_table(Path(self.test_session_data.tally_table))
+            else:
+                self._update_from_counters()
             self.testing_started = self.test_session_data.session_started
             self.testing_complete = self.test_session_data.session_finished
 
+    def _update_from_counters(self) -> None:
+        # The plugin keeps running/finished counts up to date itself, so there
+        # is no need to walk every test
+        self.num_running = self.test_session_data.num_tests_running
+        self.num_finished = self.test_session_data.num_tests_finished
+
+    def _update_from_status_table(self, table_path: Path) -> None:
+        # In 'mmap' mode the data file only has session-level info; per-test
+        # status is read from the memory-mapped table it points to
+        if (
+            self.status_table is None
+            or self.status_table.file_path != table_path
+            or self.status_table.is_stale()
+        ):
+            if self.status_table is not None:
+                self.status_table.close()
+            self.status_table = MmapStatusTable(file_path=table_path)
+        counts = self.status_table.counts()
+        self.num_running = counts["running"]
+        self.num_finished = counts["finished"]
+        self.test_session_data.tally_tests = self.status_table.tally_tests()
+
 
 class FileChangeEventHandler(FileSystemEventHandler):
-    def __init__(self, callback):
+    """Calls back when the data file is rewritten in place or replaced"""
+
+    def __init__(self, file_path: Path, callback):
+        self.file_path = file_path.resolve()
         self.callback = callback
 
-    def on_modified(self, event):
-        if not event.is_directory and Path(event.src_path) == self.file_path:
-            self.callback()
+    def on_any_event(self, event):
+        if event.is_directory:
+            return
+        # Atomic publishes show up as a move of the temp file onto the data file
+        for path in (event.src_path, getattr(event, "dest_path", "")):
+            if path and Path(path) == self.file_path:
+                self.callback()
+                return
 
 
 class TestResultsGUI:
@@ -112,10 +165,20 @@ class TestResultsGUI:
         self.file_path = DEFAULT_FILE
         self.max_rows = None
 
+        # Watchdog and socket threads only set `changed`; the parse worker
+        # thread turns it into a Snapshot in `pending`, and the Tk main loop
+        # applies the newest pending snapshot at most every UI_REFRESH_TIME_MS
+        self.changed = threading.Event()
+        self.pending: Snapshot = None
+        self.pending_lock = threading.Lock()
+        self.snapshot: Snapshot = None
+
         self.create_widgets()
         self.file_observer = None  # Initialize the file_observer attribute
+        threading.Thread(target=self.parse_worker, daemon=True).start()
         if self.file_path:
             self.start_file_monitoring()
+        self.root.after(UI_REFRESH_TIME_MS, self.apply_snapshot)
 
     def create_widgets(self):
         self.title_label = tk.Label(
@@ -134,11 +197,15 @@ class TestResultsGUI:
         self.table_tab = tk.Frame(self.notebook)
         self.notebook.add(self.table_tab, text="Results")
 
+        self.slowest_tab = tk.Frame(self.notebook)
+        self.notebook.add(self.slowest_tab, text="Slowest")
+
         self.config_tab = tk.Frame(self.notebook)
         self.notebook.add(self.config_tab, text="Configuration")
 
         self.create_config_widgets()
         self.create_table_widgets()
+        self.create_slowest_widgets()
 
         # Create a label to display the lastline
         self.lastline_label = tk.Label(
@@ -152,6 +219,19 @@ class TestResultsGUI:
             row=2, column=0, columnspan=3, padx=10, pady=5, sticky="nsew"
         )
 
+        # Progress bar (weighted by expected test time when the plugin has a
+        # duration history) and estimated time remaining
+        self.progress_bar = Progressbar(
+            self.root, orient=tk.HORIZONTAL, mode="determinate", maximum=1.0
+        )
+        self.progress_bar.grid(row=3, column=0, columnspan=2, padx=10, sticky="ew")
+        self.eta_label = tk.Label(self.root, font=("Arial", 12), anchor="w")
+        self.eta_label.grid(row=3, column=2, padx=10, sticky="w")
+
+        # Test throughput, over the plugin's sliding window and overall
+        self.rates_label = tk.Label(self.root, font=("Arial", 12))
+        self.rates_label.grid(row=4, column=0, columnspan=3, padx=10, pady=5)
+
     def create_config_widgets(self):
         self.config_frame = tk.Frame(self.config_tab)
         self.config_frame.pack(pady=10)
@@ -173,67 +253,69 @@ class TestResultsGUI:
         self.max_rows_entry = tk.Entry(self.config_frame, width=10)
         self.max_rows_entry.grid(row=0, column=4, padx=5, sticky="w")
 
+        self.socket_var = tk.BooleanVar(value=False)
+        self.socket_check = tk.Checkbutton(
+            self.config_frame, text="Socket", variable=self.socket_var
+        )
+        self.socket_check.grid(row=0, column=5, padx=5, sticky="w")
+
         self.apply_button = tk.Button(
             self.config_frame, text="Apply", command=self.apply_config
         )
-        self.apply_button.grid(row=0, column=5, padx=5, sticky="w")
+        self.apply_button.grid(row=0, column=6, padx=5, sticky="w")
 
     def create_table_widgets(self):
         self.table_frame = tk.Frame(self.table_tab)
-        self.table_frame.pack(pady=10)
-
-        self.table_header = tk.Frame(self.table_frame)
-        self.table_header.pack()
-
-        for i, header in enumerate(TABLE_COLUMNS):
-            label = tk.Label(
-                self.table_header,
-                text=header.name,
-                font=("Arial", 14, "bold"),
-                width=header.width,
-                anchor="w",
+        self.table_frame.pack(pady=10, fill=tk.BOTH, expand=True)
+
+        style = Style()
+        style.configure("Tally.Treeview", font=("Arial", 14), rowheight=30)
+        style.configure("Tally.Treeview.Heading", font=("Arial", 14, "bold"))
+
+        # A Treeview only draws the rows in view, and rows are updated in place
+        # (see update_table), so the table stays responsive with many tests
+        self.table_tree = Treeview(
+            self.table_frame,
+            columns=[column.name.strip() for column in TABLE_COLUMNS],
+            show="headings",
+            style="Tally.Treeview",
+            height=12,
+        )
+        for column in TABLE_COLUMNS:
+            self.table_tree.heading(column.name.strip(), text=column.name, anchor="w")
+            self.table_tree.column(
+                column.name.strip(), width=column.width * CHAR_WIDTH, anchor="w"
             )
-            label.grid(row=0, column=i, padx=10, pady=5, sticky="w")
-
-        self.table_canvas = tk.Canvas(self.table_frame, height=400)
-        self.table_canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
 
-        # Create the table body and configure the canvas
-        self.table_body = tk.Frame(self.table_canvas)
-        self.table_canvas.create_window((0, 0), window=self.table_body, anchor="nw")
-
-        # Create the scrollbar after creating the canvas
         self.table_scrollbar = tk.Scrollbar(
-            self.table_frame, orient=tk.VERTICAL, command=self.table_canvas.yview
+            self.table_frame, orient=tk.VERTICAL, command=self.table_tree.yview
         )
+        self.table_tree.configure(yscrollcommand=self.table_scrollbar.set)
         self.table_scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
-
-        # Configure the canvas to use the scrollbar
-        self.table_canvas.configure(yscrollcommand=self.table_scrollbar.set)
-
-        # Bind the scrollbar and canvas together
-        self.table_scrollbar.config(command=self.table_canvas.yview)
-        self.table_canvas.bind_all(
-            "<MouseWheel>",
-            lambda event: self.table_canvas.yview_scroll(
-                int(-1 * (event.delta / 120)), "units"
-            ),
-        )
-
-        # Configure the table_body to expand with the window size
-        self.table_body.bind(
-            "<Configure>",
-            lambda event: self.table_canvas.configure(
-                scrollregion=self.table_canvas.bbox("all")
-            ),
+        self.table_tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+
+        # (duration, outcome) currently shown for each node ID (the row's item
+        # ID in the Treeview is the node ID itself), and all node IDs in
+        # display order
+        self.table_rows: Dict[str, Tuple[float, str]] = {}
+        self.table_order: List[str] = []
+
+    def create_slowest_widgets(self):
+        # Top-K slowest tests as published by the plugin (--tally-top-slowest)
+        self.slowest_tree = Treeview(
+            self.slowest_tab,
+            columns=("category", "node_id", "duration"),
+            show="headings",
+            height=15,
         )
-
-        # Attach the table_body to the canvas
-        self.table_canvas.create_window((0, 0), window=self.table_body, anchor="nw")
-
-        # Create the footer frame
-        self.table_footer = tk.Frame(self.table_frame)
-        self.table_footer.pack(side=tk.BOTTOM, fill=tk.X, pady=10)
+        for column, heading, width in (
+            ("category", "Category", 100),
+            ("node_id", "Test", 600),
+            ("duration", "Duration", 150),
+        ):
+            self.slowest_tree.heading(column, text=heading, anchor="w")
+            self.slowest_tree.column(column, width=width, anchor="w")
+        self.slowest_tree.pack(pady=10, fill=tk.BOTH, expand=True)
 
     def browse_file(self):
         file_path = filedialog.askopenfilename(filetypes=[("JSON files", "*.json")])
@@ -250,73 +332,144 @@ class TestResultsGUI:
         if self.file_path and max_rows:
             self.max_rows = int(max_rows)
 
+            self.reset_table()
             self.fetch_results()
 
     def fetch_results(self):
-        if self.file_path is not None and self.file_path.is_file():
-            self.stats.update_stats(file_path=self.file_path)
-
-            if self.stats.test_session_data:
-                self.update_table(self.stats.test_session_data.tally_tests)
-            else:
+        # Safe to call from any thread; the parse happens on the worker
+        self.changed.set()
+
+    def parse_worker(self):
+        # However many change signals arrive while a parse is running, they
+        # result in a single further parse
+        while True:
+            self.changed.wait()
+            self.changed.clear()
+            file_path = self.file_path
+            if file_path is None or (
+                self.stats.subscriber is None and not file_path.is_file()
+            ):
+                print("Invalid file path.")
+                continue
+            self.stats.update_stats(file_path=file_path)
+            if not self.stats.test_session_data:
                 print("Error loading test session data.")
-        else:
-            print("Invalid file path.")
-
-    def update_table(self, results):
-        # Clear the table body
-        for widget in self.table_body.winfo_children():
-            widget.destroy()
-
-        # Sort the results by node_id
-        sorted_results = sorted(results.values(), key=lambda x: x["node_id"])
-
-        # Display the maximum number of rows specified
-        for i, result in enumerate(sorted_results[: self.max_rows]):
-            row_frame = tk.Frame(self.table_body)
-            row_frame.grid(row=i, column=0, padx=5, pady=2, sticky="w")
-
-            node_id_label = tk.Label(
-                row_frame,
-                text=result["node_id"],
-                font=("Arial", 14),
-                width=TABLE_COLUMNS[0].width,
-                anchor="w",
-            )
-            node_id_label.grid(row=0, column=0, padx=10, pady=5, sticky="w")
-
-            duration_label = tk.Label(
-                row_frame,
-                text=render(Duration(result["test_duration"]), "s"),
-                font=("Arial", 14),
-                width=TABLE_COLUMNS[1].width,
-                anchor="w",
+                continue
+            snapshot = Snapshot(
+                test_session_data=self.stats.test_session_data,
+                num_finished=self.stats.num_finished,
+                tot_num_to_run=self.stats.tot_num_to_run,
             )
-            duration_label.grid(row=0, column=1, padx=10, pady=5, sticky="w")
-
-            outcome_label = tk.Label(
-                row_frame,
-                text=result["test_outcome"],
-                font=("Arial", 14),
-                width=TABLE_COLUMNS[2].width,
-                anchor="w",
+            with self.pending_lock:
+                self.pending = snapshot
+
+    def apply_snapshot(self):
+        # Runs on the Tk main loop; snapshots the worker produced since the
+        # last run are dropped in favor of the newest one
+        with self.pending_lock:
+            snapshot, self.pending = self.pending, None
+        if snapshot is not None:
+            self.snapshot = snapshot
+            self.update_table(snapshot.test_session_data.tally_tests)
+        elif self.snapshot is not None:
+            # The rates fall while no test finishes, without the plugin
+            # publishing anything new
+            self.rates_label.config(
+                text=format_rates(self.snapshot.test_session_data.rates)
             )
-            outcome_label.grid(row=0, column=2, padx=10, pady=5, sticky="w")
+        self.root.after(UI_REFRESH_TIME_MS, self.apply_snapshot)
+
+    def reset_table(self):
+        self.table_tree.delete(*self.table_tree.get_children())
+        self.table_rows.clear()
+        self.table_order.clear()
+
+    def update_table(self, results):
+        # Diff the results against the rows on screen: new tests are inserted
+        # at their place in node ID order and only rows whose duration or
+        # outcome changed are patched, so the work done follows the changes
+        # rather than the size of the suite
+        tree, rows, order = self.table_tree, self.table_rows, self.table_order
+        max_rows = self.max_rows
+        for node_id, result in results.items():
+            state = (result["test_duration"], result["test_outcome"])
+            shown = rows.get(node_id)
+            if shown == state:
+                continue
+            rows[node_id] = state
+            index = bisect_left(order, node_id)
+            if shown is None:
+                order.insert(index, node_id)
+            # Display the maximum number of rows specified
+            if max_rows is not None and index >= max_rows:
+                continue
+            values = (node_id, render(Duration(state[0] or 0.0), "s"), state[1] or "")
+            if shown is not None:
+                tree.item(node_id, values=values)
+                continue
+            tree.insert("", index, iid=node_id, values=values)
+            if max_rows is not None and len(order) > max_rows:
+                tree.delete(order[max_rows])
+
+        # Tests gone from the results (e.g. a new session started): rebuild
+        if len(rows) > len(results):
+            self.reset_table()
+            self.update_table(results)
+            return
 
         # Clear the lastline label
         self.lastline_label.config(text="")
 
         # Update the lastline label with final test results
-        if self.stats.test_session_data:
-            lastline = self.stats.test_session_data.lastline
+        if self.snapshot.test_session_data:
+            lastline = self.snapshot.test_session_data.lastline
             self.lastline_label.config(text=lastline)
+            self.update_progress()
+            self.update_slowest()
+
+    def update_progress(self):
+        data = self.snapshot.test_session_data
+        if data.completion_fraction is not None:
+            value = data.completion_fraction
+        elif self.snapshot.tot_num_to_run:
+            value = self.snapshot.num_finished / self.snapshot.tot_num_to_run
+        else:
+            value = 0.0
+        self.progress_bar.config(value=value)
+        self.eta_label.config(
+            text="" if data.session_finished else format_eta(data.eta)
+        )
+        self.rates_label.config(text=format_rates(data.rates))
+
+    def update_slowest(self):
+        # Only K rows per category, so redrawing them all is cheap
+        self.slowest_tree.delete(*self.slowest_tree.get_children())
+        for category, entries in (
+            self.snapshot.test_session_data.slowest or {}
+        ).items():
+            for entry in entries:
+                self.slowest_tree.insert(
+                    "",
+                    tk.END,
+                    values=(
+                        category,
+                        entry["node_id"],
+                        render(Duration(entry["duration"]), "s"),
+                    ),
+                )
 
     def start_file_monitoring(self):
-        if self.file_path is not None and self.file_path.is_file():
-            event_handler = FileChangeEventHandler(self.file_changed_callback)
-            event_handler.file_path = (
-                self.file_path
-            )  # Set the file_path attribute in the event handler
+        self.stop_file_monitoring()
+        if self.file_path is not None and self.socket_var.get():
+            # Updates are pushed by the plugin (--tally-socket) instead of being
+            # picked up by watching the data file
+            self.stats.subscriber = TallySocketSubscriber(
+                socket_path=socket_path_for(self.file_path),
+                on_update=self.changed.set,
+            )
+            self.stats.subscriber.start()
+        elif self.file_path is not None and self.file_path.is_file():
+            event_handler = FileChangeEventHandler(self.file_path, self.changed.set)
             self.file_observer = Observer()
             self.file_observer.schedule(
                 event_handler, str(self.file_path.parent), recursive=False
@@ -324,14 +477,17 @@ class TestResultsGUI:
             self.file_observer.start()
         else:
             print("Invalid file path.")
-
-    def file_changed_callback(self):
-        self.fetch_results()
+            return
+        self.changed.set()
 
     def stop_file_monitoring(self):
         if self.file_observer:
             self.file_observer.stop()
             self.file_observer.join()
+            self.file_observer = None
+        if self.stats.subscriber is not None:
+            self.stats.subscriber.close()
+            self.stats.subscriber = None
 
     def __del__(self):
         self.stop_file_monitoring()
@@ -1,27 +1,63 @@
+import argparse
+import datetime
 import logging
 import os
-import re
+import sys
+import time
+from collections import Counter
 from pathlib import Path
+from typing import List, Tuple
 
 import pytest
 from _pytest.config import Config, ExitCode
 from _pytest.main import Session
-from _pytest.nodes import Item
 from _pytest.reports import TestReport
-from _pytest.runner import CallInfo
-from _pytest.stash import Stash, StashKey
-from _pytest.terminal import TerminalReporter
-from strip_ansi import strip_ansi
-
-from pytest_tally.classes import TallyReport, TallySession, TallyTest
-from pytest_tally.utils import LocakbleJsonFileUtils
+from _pytest.stash import StashKey
+
+from pytest_tally.classes import (
+    TallyRates,
+    TallyReport,
+    TallySession,
+    TallySlowest,
+    TallyTest,
+)
+from pytest_tally.utils import (
+    TALLY_CODECS,
+    AtomicJsonFileUtils,
+    BackgroundFlusher,
+    DurationHistory,
+    LocakbleJsonFileUtils,
+    MmapStatusTable,
+    NdjsonEventLog,
+    TallyDatabase,
+    TallySocketServer,
+    get_codec,
+    socket_path_for,
+)
 
 DEFAULT_FILE = Path(os.getcwd()) / "tally-data.json"
 FLUSH_TIME = 0.05
-
-pytest_tally_enabled = StashKey[bool]()
-pytest_tally_json_file = StashKey[Path]()
-pytest_tally_session = StashKey[TallySession]()
+SNAPSHOT_TIME = 1.0
+RATE_WINDOW = 10
+TOP_SLOWEST = 10
+TALLY_FORMATS = ["json", "events", "mmap"]
+TALLY_PUBLISH_MODES = ["atomic", "lock"]
+
+# Outcomes in the same order, wording and colors as pytest's own summary line
+# (used only when there is no terminal reporter to ask for it)
+LASTLINE_OUTCOMES = [
+    ("failed", "red"),
+    ("passed", "green"),
+    ("skipped", "yellow"),
+    ("xfailed", "yellow"),
+    ("xpassed", "yellow"),
+    ("error", "red"),
+]
+ANSI_CODES = {"red": "\x1b[31m", "green": "\x1b[32m", "yellow": "\x1b[33m"}
+ANSI_BOLD = "\x1b[1m"
+ANSI_RESET = "\x1b[0m"
+
+pytest_tally_plugin = StashKey["TallyPlugin"]()
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -32,12 +68,23 @@ stream_handler.setFormatter(formatter)
 logger.addHandler(stream_handler)
 
 
-def check_tally_enabled(config: Config) -> bool:
-    stash: Stash = config.stash
-    stash["pytest_tally_enabled"] = (
-        bool(config.option.tally) if hasattr(config.option, "tally") else False
-    )
-    return stash["pytest_tally_enabled"]
+def parse_top_slowest(value: str) -> Tuple[int, Tuple[str, ...]]:
+    """Parse --tally-top-slowest=K[:CATEGORY,...] into (K, categories)"""
+    k, _, categories = value.partition(":")
+    try:
+        k = int(k)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected K[:CATEGORY,...], got '{value}'")
+    if k < 0:
+        raise argparse.ArgumentTypeError(f"K must not be negative, got {k}")
+    categories = tuple(c.strip() for c in categories.split(",") if c.strip())
+    unknown = set(categories) - set(TallySlowest.CATEGORIES)
+    if unknown:
+        raise argparse.ArgumentTypeError(
+            f"unknown categories {', '.join(sorted(unknown))}; expected"
+            f" {', '.join(TallySlowest.CATEGORIES)}"
+        )
+    return k, categories or ("test",)
 
 
 def pytest_addoption(parser) -> None:
@@ -59,130 +106,394 @@ def pytest_addoption(parser) -> None:
             " tally-data.json in the current working directory."
         ),
     )
-
-
-def pytest_cmdline_main(config: Config) -> None:
-    # Define stash values here since this is one of the first pytest hooks to run in a sssion
-    stash: Stash = config.stash
-    stash["pytest_tally_enabled"] = (
-        bool(config.option.tally) if hasattr(config.option, "tally") else False
+    group.addoption(
+        "--tally-format",
+        action="store",
+        default="json",
+        choices=TALLY_FORMATS,
+        help=(
+            "Output format for the pytest-tally data. 'json' (default) rewrites the"
+            " whole session to the data file on every update. 'events' appends one"
+            " record per state change to an NDJSON log next to the data file, and"
+            " only writes a compact snapshot to the data file periodically. 'mmap'"
+            " keeps per-test status in a memory-mapped table next to the data file,"
+            " updated in place, and only writes session-level data to the data file."
+        ),
     )
-    if not stash["pytest_tally_enabled"]:
-        return
-    stash["pytest_tally_json_file"] = (
-        Path(config.option.tally_file)
-        if hasattr(config.option, "tally_file")
-        else DEFAULT_FILE
+    group.addoption(
+        "--tally-flush-interval",
+        action="store",
+        type=float,
+        default=FLUSH_TIME,
+        help=(
+            "Minimum number of seconds between two writes of the pytest-tally data"
+            " file. Writes are made by a background thread and coalesced, so tests"
+            f" never wait on the file. Defaults to {FLUSH_TIME}; 0 writes"
+            " synchronously from each hook instead."
+        ),
+    )
+    group.addoption(
+        "--tally-publish",
+        action="store",
+        default="atomic",
+        choices=TALLY_PUBLISH_MODES,
+        help=(
+            "How the pytest-tally data file is published. 'atomic' (default) writes"
+            " a temporary sibling file and renames it over the data file, so clients"
+            " never wait for the plugin or see a partial file. 'lock' rewrites the"
+            " data file in place under an exclusive file lock, which clients wait"
+            " for."
+        ),
+    )
+    group.addoption(
+        "--tally-codec",
+        action="store",
+        default=None,
+        choices=list(TALLY_CODECS),
+        help=(
+            "Encoding of the pytest-tally data file. 'json' is indented json,"
+            " 'compact' is minified json, 'orjson' and 'msgpack' need the package of"
+            " the same name installed. Clients detect the codec automatically."
+            " Defaults to 'json', or 'compact' with --tally-format=events."
+        ),
+    )
+    group.addoption(
+        "--tally-socket",
+        action="store_true",
+        help=(
+            "Serve a Unix domain socket next to the pytest-tally data file (same"
+            " name, '.sock' suffix) and push every state change to the clients"
+            " connected to it, starting with a snapshot of the session. The data"
+            " file itself is then only written periodically."
+        ),
+    )
+    group.addoption(
+        "--tally-db",
+        action="store_true",
+        help=(
+            "Also record sessions, tests and phase reports into a SQLite database"
+            " (WAL mode) next to the pytest-tally data file (same name, '.db'"
+            " suffix). Rows are inserted in batches, each time the data file is"
+            " written. Sessions accumulate across runs."
+        ),
+    )
+    group.addoption(
+        "--tally-no-history",
+        action="store_true",
+        help=(
+            "Do not keep the per-test duration history (in pytest's cache) that the"
+            " time-weighted completion fraction and the ETA are estimated from."
+        ),
+    )
+    group.addoption(
+        "--tally-rate-window",
+        action="store",
+        type=int,
+        default=RATE_WINDOW,
+        help=(
+            "Length in seconds of the sliding window over which the published test"
+            " throughput (tests/sec, overall and per outcome) is measured. Defaults"
+            f" to {RATE_WINDOW}."
+        ),
+    )
+    group.addoption(
+        "--tally-top-slowest",
+        action="store",
+        type=parse_top_slowest,
+        default=(TOP_SLOWEST, ("test",)),
+        metavar="K[:CATEGORY,...]",
+        help=(
+            "Publish the K slowest tests seen so far, for each of the given"
+            " comma-separated categories: 'test' (whole test), 'setup', 'call',"
+            f" 'teardown'. Defaults to {TOP_SLOWEST}:test; 0 disables it. E.g."
+            " --tally-top-slowest=20:test,setup,teardown."
+        ),
     )
-
-    pytest_tally_session = stash.get("pytest_tally_session", None)
-    if not pytest_tally_session:
-        stash["pytest_tally_session"] = TallySession(config=config)
-
-
-def write_json_to_file(config: Config) -> None:
-    stash: Stash = config.stash
-    file_path = stash.get("pytest_tally_json_file", DEFAULT_FILE)
-    os.makedirs(file_path.parent, exist_ok=True)
-    session_data = stash["pytest_tally_session"].to_json()
-    lock_utils = LocakbleJsonFileUtils(file_path=file_path)
-    lock_utils.overwrite_json(session_data)
 
 
-def pytest_sessionstart(session: Session) -> None:
-    if not check_tally_enabled(session.config):
+@pytest.hookimpl(trylast=True)  # do not remove!
+def pytest_configure(config: Config) -> None:
+    # The plugin object (and with it every runtest hook) is only registered when
+    # --tally is given, so a run without it pays nothing for pytest-tally being
+    # installed. pytest-xdist workers forward their reports to the controller,
+    # which is the only process that aggregates and publishes the tally data.
+    if not getattr(config.option, "tally", False) or hasattr(config, "workerinput"):
         return
 
-    pytest_tally_session = session.config.stash["pytest_tally_session"]
-    pytest_tally_session.timer.start()
-    pytest_tally_session.session_started = True
-    pytest_tally_session.session_duration = pytest_tally_session.timer.elapsed
-    write_json_to_file(session.config)
+    tally_plugin = TallyPlugin(config)
+    config.stash[pytest_tally_plugin] = tally_plugin
+    config.pluginmanager.register(tally_plugin, "tally_plugin")
 
 
-def pytest_collection_finish(session: Session) -> None:
-    if not check_tally_enabled(session.config):
-        return
-
-    pytest_tally_session = session.config.stash["pytest_tally_session"]
-    pytest_tally_session.num_tests_to_run = len(session.items)
-    pytest_tally_session.session_duration = pytest_tally_session.timer.elapsed
-    write_json_to_file(session.config)
+def pytest_unconfigure(config: Config) -> None:
+    tally_plugin = config.stash.get(pytest_tally_plugin, None)
+    if tally_plugin is not None:
+        tally_plugin.close()
+        config.pluginmanager.unregister(tally_plugin)
+        del config.stash[pytest_tally_plugin]
 
 
-@pytest.hookimpl(hookwrapper=True)
-def pytest_runtest_setup(item: Item):
-    if not check_tally_enabled(item.session.config):
-        yield
-        return
-
-    tally_test = TallyTest(node_id=item.nodeid)
-    tally_test.timer.reset()
-    tally_test.timer.start()
-    pytest_tally_session = item.session.config.stash["pytest_tally_session"]
-    pytest_tally_session.tally_tests[item.nodeid] = tally_test
+class TallyPlugin:
+    """
+    Plugin object registered by pytest_configure when --tally is given.
 
-    if pytest_tally_session.num_tests_have_run == 0:
-        write_json_to_file(item.session.config)
-    pytest_tally_session.num_tests_have_run += 1
-    yield
+    Holds the tally session and everything that publishes it (data file,
+    background flusher, event log, status table). Test progress is taken from
+    pytest_runtest_logstart / pytest_runtest_logreport, which fire for tests
+    run in-process as well as for the reports pytest-xdist workers forward to
+    the controller, so the same hooks serve both cases.
+    """
 
+    def __init__(self, config: Config) -> None:
+        self.config = config
+        self.json_file = Path(getattr(config.option, "tally_file", DEFAULT_FILE))
+        self.format = getattr(config.option, "tally_format", "json")
+        codec_name = getattr(config.option, "tally_codec", None) or (
+            "compact" if self.format == "events" else "json"
+        )
+        try:
+            self.codec = get_codec(codec_name)
+        except ValueError as e:
+            raise pytest.UsageError(str(e))
+        self.tally_session = TallySession(config=config)
+        self.event_log: NdjsonEventLog = None
+        self.flusher: BackgroundFlusher = None
+        self.table: MmapStatusTable = None
+        self.socket_server: TallySocketServer = None
+        self.database: TallyDatabase = None
+        self.database_session_id: int = None
+        self.history: DurationHistory = None
+        # Expected duration of a test without history, and the expected time of
+        # all collected tests / of the tests finished so far
+        self.expected_default: float = None
+        self.expected_total: float = 0.0
+        self.expected_done: float = 0.0
+        self.collected = False
+
+    def close(self) -> None:
+        if self.flusher is not None:
+            self.flusher.stop(final_flush=False)
+            self.flusher = None
+        if self.event_log is not None:
+            self.event_log.close()
+            self.event_log = None
+        if self.table is not None:
+            self.table.close()
+            self.table = None
+        if self.socket_server is not None:
+            self.socket_server.close()
+            self.socket_server = None
+        if self.database is not None:
+            self.database.close()
+            self.database = None
+
+    def write_json_to_file(self) -> None:
+        os.makedirs(self.json_file.parent, exist_ok=True)
+        # In 'mmap' mode per-test data lives in the status table, not the data file
+        raw = self.tally_session.encode(self.codec, include_tests=self.format != "mmap")
+        if getattr(self.config.option, "tally_publish", "atomic") == "lock":
+            file_utils = LocakbleJsonFileUtils(file_path=self.json_file)
+        else:
+            file_utils = AtomicJsonFileUtils(file_path=self.json_file)
+        file_utils.overwrite_bytes(raw)
+
+    def flush(self) -> None:
+        self.write_json_to_file()
+        if self.database is not None:
+            self.database.commit()
+
+    def request_flush(self) -> None:
+        # Hooks only mark the session dirty; the background flusher (if running)
+        # decides when the data file actually gets written
+        if self.flusher is None:
+            self.flush()
+            return
+        self.flusher.mark_dirty()
+
+    def start_flusher(self) -> None:
+        # In 'events' mode (or with --tally-socket) the data file is only a periodic
+        # snapshot; per-test state changes go to the event log or the socket instead
+        # (see write_event)
+        interval = getattr(self.config.option, "tally_flush_interval", FLUSH_TIME)
+        if self.format == "events" or self.socket_server is not None:
+            interval = max(interval, SNAPSHOT_TIME)
+        if interval <= 0:
+            return
+        self.flusher = BackgroundFlusher(flush=self.flush, interval=interval)
+        self.flusher.start()
 
-@pytest.hookimpl(trylast=True)  # do not remove!
-def pytest_configure(config: Config) -> None:
-    if not check_tally_enabled(config):
-        # yield
-        return
+    def stop_flusher(self) -> None:
+        if self.flusher is None:
+            self.flush()
+            return
+        flusher, self.flusher = self.flusher, None
+        flusher.stop(final_flush=True)
 
-    assert config.pluginmanager.hasplugin("terminal")
-
-    stash = config.stash
-    pytest_tally_session = stash.get("pytest_tally_session", None)
-    if not pytest_tally_session:
-        stash["pytest_tally_session"] = TallySession(config=config)
-
-    # This code exists solely to extract the single 'lastline' of the session for
-    # display in the dashboard. It is a hacky way to do it, but it works.
-    tr = config.pluginmanager.getplugin("terminalreporter")
-    if tr is not None:
-        oldwrite = tr._tw.write
-
-        def tee_write(s, **kwargs):
-            lastline_matcher = re.compile(r"^==.*in\s\d+.\d+s.*=+")
-            oldwrite(s, **kwargs)
-            match = re.search(lastline_matcher, s)
-            if match:
-                pytest_tally_session.lastline_ansi = match.string.replace(
-                    "=", ""
-                ).strip()
-                pytest_tally_session.lastline = (
-                    strip_ansi(match.string).replace("=", "").strip()
+    def write_event(self, event: str, tally_test: TallyTest = None, **fields) -> None:
+        has_clients = (
+            self.socket_server is not None and self.socket_server.has_clients()
+        )
+        if self.event_log is None and not has_clients:
+            return
+        record = {"event": event, "ts": time.time(), **fields}
+        if self.event_log is not None:
+            self.event_log.append(record)
+        if has_clients:
+            # Socket clients get the current session header (and test) with every
+            # event, so they can apply events without replaying the whole stream
+            header = self.tally_session.to_json(include_tests=False)
+            del header["tally_tests"]
+            record["session"] = header
+            if tally_test is not None:
+                record["test"] = tally_test.to_json()
+            self.socket_server.publish(record)
+
+    def socket_snapshot(self) -> bytes:
+        # Built from the session's cached per-test fragments (with the data
+        # file's codec unless that is a binary one), so a resync re-encodes only
+        # the tests that changed since the last data file write
+        codec = get_codec("compact") if self.codec.binary else self.codec
+        return self.tally_session.encode(codec)
+
+    def pytest_sessionstart(self, session: Session) -> None:
+        if self.format == "events":
+            self.event_log = NdjsonEventLog(
+                file_path=self.json_file.with_suffix(".ndjson")
+            )
+        if getattr(self.config.option, "tally_socket", False):
+            self.socket_server = TallySocketServer(
+                socket_path=socket_path_for(self.json_file),
+                snapshot=self.socket_snapshot,
+            )
+            try:
+                self.socket_server.start()
+            except OSError as e:
+                self.socket_server = None
+                raise pytest.UsageError(
+                    "--tally-socket: cannot listen on"
+                    f" {socket_path_for(self.json_file)}: {e}"
                 )
-                write_json_to_file(config)
-
-        tr._tw.write = tee_write
+        if getattr(self.config.option, "tally_db", False):
+            self.database = TallyDatabase(
+                file_path=self.json_file.with_suffix(".db"), writable=True
+            )
+            self.database_session_id = self.database.start_session(time.time())
 
+        tally_session = self.tally_session
+        tally_session.timer.start()
+        tally_session.rates = TallyRates(
+            window=max(1, getattr(self.config.option, "tally_rate_window", RATE_WINDOW))
+        )
+        tally_session.rates.start()
+        k, categories = getattr(
+            self.config.option, "tally_top_slowest", (TOP_SLOWEST, ("test",))
+        )
+        if k > 0:
+            tally_session.slowest = TallySlowest(k=k, categories=categories)
+        tally_session.session_started = True
+        tally_session.session_duration = tally_session.timer.elapsed
+
+        self.write_event("session_start")
+        self.start_flusher()
+        self.request_flush()
+
+    def pytest_collection_finish(self, session: Session) -> None:
+        # Under pytest-xdist the controller collects nothing; the collection
+        # reported by the workers is recorded instead
+        if self.config.pluginmanager.has_plugin("dsession"):
+            return
+        self.record_collection([item.nodeid for item in session.items])
 
-@pytest.hookimpl(hookwrapper=True)
-def pytest_runtest_makereport(item: Item, call: CallInfo) -> None:
-    if not check_tally_enabled(item.session.config):
-        yield
-        return  # do we need both yield and return?
+    @pytest.hookimpl(optionalhook=True)
+    def pytest_xdist_node_collection_finished(self, node, ids: List[str]) -> None:
+        # Every worker collects the same test IDs; record them once
+        if self.collected:
+            return
+        self.record_collection(ids)
+
+    def record_collection(self, node_ids: List[str]) -> None:
+        self.collected = True
+        tally_session = self.tally_session
+        tally_session.num_tests_to_run = len(node_ids)
+        tally_session.session_duration = tally_session.timer.elapsed
+        if self.format == "mmap":
+            self.table = MmapStatusTable.create(
+                file_path=self.json_file.with_suffix(".mmap"), node_ids=node_ids
+            )
+            # Absolute, so clients started from another directory find it too
+            tally_session.tally_table = str(self.table.file_path.resolve())
+        self.load_history(node_ids)
+        self.write_event(
+            "collection_finish",
+            num_tests_to_run=tally_session.num_tests_to_run,
+        )
+        self.request_flush()
 
-    else:
-        session_config = item.session.config
-        pytest_tally_session = session_config.stash["pytest_tally_session"]
+    def load_history(self, node_ids: List[str]) -> None:
+        # The history lives in pytest's cache, so it is disabled along with the
+        # cacheprovider plugin (-p no:cacheprovider)
+        cache = getattr(self.config, "cache", None)
+        if cache is None or getattr(self.config.option, "tally_no_history", False):
+            return
+        self.history = DurationHistory(
+            file_path=Path(cache.mkdir("tally")) / "durations"
+        )
+        known = [
+            duration
+            for duration in map(self.history.durations.get, node_ids)
+            if duration is not None
+        ]
+        if not known:
+            return
+        # Tests that never ran before are assumed to take the mean known time
+        self.expected_default = sum(known) / len(known)
+        self.expected_total = sum(known) + self.expected_default * (
+            len(node_ids) - len(known)
+        )
+        if self.expected_total > 0:
+            self.tally_session.completion_fraction = 0.0
+
+    def update_completion(self, node_id: str) -> None:
+        # O(1) per test: the fraction is the expected time of the tests finished
+        # so far over the expected time of all tests, and the ETA extrapolates
+        # the wall-clock time it took to get there (which accounts for machine
+        # speed and xdist parallelism)
+        tally_session = self.tally_session
+        self.expected_done += self.history.get(node_id, self.expected_default)
+        fraction = min(self.expected_done / self.expected_total, 1.0)
+        tally_session.completion_fraction = fraction
+        tally_session.eta = (
+            tally_session.session_duration * (1 - fraction) / fraction
+            if fraction > 0
+            else None
+        )
 
-        r = yield
-        report = r.get_result()
-        if report.when == "teardown":
-            try:
-                pytest_tally_session.tally_tests[item.nodeid].timer.pause()
-            except KeyError:
-                logger.warning(f"Could not find tally test for node ID {item.nodeid}")
-                return
-            pytest_tally_session.session_duration = pytest_tally_session.timer.elapsed
-            write_json_to_file(item.session.config)
+    def save_history(self) -> None:
+        with self.tally_session.lock:
+            for node_id, tally_test in self.tally_session.tally_tests.items():
+                if tally_test.is_finished():
+                    self.history.update(node_id, tally_test.test_duration)
+        self.history.save()
+
+    def pytest_runtest_logstart(self, nodeid: str, location) -> None:
+        tally_test = TallyTest(node_id=sys.intern(nodeid))
+        tally_test.start()
+        tally_session = self.tally_session
+        with tally_session.lock:
+            tally_session.tally_tests[nodeid] = tally_test
+            tally_session.mark_dirty(nodeid)
+        tally_session.record_test_start()
+        self.write_event("test_start", tally_test=tally_test, node_id=nodeid)
+        if self.table is not None and nodeid in self.table.index:
+            self.table.start_test(nodeid)
+
+        if tally_session.num_tests_have_run == 0:
+            self.request_flush()
+        tally_session.num_tests_have_run += 1
+
+    def pytest_runtest_logreport(self, report: TestReport) -> None:
+        tally_session = self.tally_session
+        node_id = report.nodeid
 
         if report.when in ("setup", "teardown") and report.outcome == "failed":
             outcome = "error"
@@ -194,46 +505,234 @@ def pytest_runtest_makereport(item: Item, call: CallInfo) -> None:
         else:
             outcome = report.outcome
 
+        try:
+            tally_test = tally_session.tally_tests[node_id]
+        except KeyError:
+            logger.warning(f"Could not find tally test for node ID {node_id}")
+            return
+
+        table = self.table
+        if table is not None and node_id in table.index:
+            table.set_phase_duration(node_id, report.when, report.duration)
+        else:
+            table = None
+
+        if report.when == "teardown":
+            tally_test.stop()
+            tally_session.session_duration = tally_session.timer.elapsed
+
         tally_report = TallyReport(
-            node_id=report.nodeid,
+            node_id=sys.intern(node_id),
             when=report.when,
             outcome=report.outcome,
         )
-
-        try:
-            tally_test = pytest_tally_session.tally_tests[tally_report.node_id]
+        with tally_session.lock:
             tally_test.reports[tally_report.when] = tally_report
-        except KeyError:
-            logger.warning(
-                f"Could not find tally test for node ID {tally_report.node_id}"
-            )
-            return
+            tally_test.record_phase(report.when, report.duration)
+            update_tally_test(tally_test, tally_report, outcome, table)
+            tally_session.mark_dirty(tally_test.node_id)
 
-        if tally_test.test_outcome:
-            tally_test.timer.pause()
-            tally_test.test_duration = tally_test.timer.elapsed
-            return
+        # Reports forwarded by pytest-xdist workers carry the worker's node
+        worker = getattr(report, "node", None)
+        if worker is not None:
+            tally_session.record_worker_report(worker.gateway.id, node_id, report.when)
 
-        if tally_report.when == "setup" and outcome in ["error", "skipped"]:
-            tally_test.timer.pause()
-            tally_test.test_duration = tally_test.timer.elapsed
-            tally_test.test_outcome = outcome.capitalize()
-            return
+        if self.database is not None:
+            self.record_to_database(report, outcome, tally_test, worker)
+        if report.when == "teardown":
+            test_outcome = (
+                tally_test.test_outcome.lower() if tally_test.test_outcome else None
+            )
+            with tally_session.lock:
+                tally_session.record_test_finish(test_outcome)
+                tally_session.rates.record(test_outcome)
+                if tally_session.slowest is not None:
+                    tally_session.slowest.record(tally_test)
+            if self.expected_total > 0:
+                self.update_completion(node_id)
+
+        # Events are written once the test is updated, so that the state pushed
+        # to socket clients along with them is current
+        self.write_event(
+            "report",
+            tally_test=tally_test,
+            node_id=node_id,
+            when=report.when,
+            outcome=outcome,
+        )
+        if report.when == "teardown":
+            self.write_event(
+                "test_finish",
+                tally_test=tally_test,
+                node_id=node_id,
+                test_outcome=tally_test.test_outcome,
+                test_duration=tally_test.test_duration,
+            )
+            if table is not None:
+                table.finish_test(node_id)
+            # In 'mmap' mode this only rewrites the session header (counters,
+            # rates, slowest tests, ETA)
+            self.request_flush()
+
+    def record_to_database(
+        self, report: TestReport, outcome: str, tally_test: TallyTest, worker
+    ) -> None:
+        self.database.record_report(
+            self.database_session_id,
+            report.nodeid,
+            report.when,
+            outcome,
+            report.duration,
+        )
+        if report.when == "teardown":
+            finished_at = time.time()
+            self.database.record_test(
+                self.database_session_id,
+                report.nodeid,
+                tally_test.test_outcome.lower() if tally_test.test_outcome else None,
+                tally_test.test_duration,
+                finished_at - tally_test.elapsed,
+                finished_at,
+                worker.gateway.id if worker is not None else None,
+            )
 
-        if tally_report.when == "call":
-            tally_test.test_outcome = outcome.capitalize()
+    def pytest_sessionfinish(self, session: Session, exitstatus: ExitCode) -> None:
+        # This called after whole test run finished, right before returning the exit status to the system.
+        tally_session = self.tally_session
+        tally_session.timer.pause()
+        tally_session.session_duration = tally_session.timer.elapsed
+        tally_session.session_finished = True
+        if tally_session.rates is not None:
+            # Clients evaluate the rates as of the end of the session from now on
+            tally_session.rates.stop()
+        if tally_session.completion_fraction is not None:
+            tally_session.completion_fraction = 1.0
+            tally_session.eta = 0.0
+        if self.history is not None:
+            self.save_history()
+        # The terminal reporter's summary line is complete by now except for
+        # warnings issued while the session finishes; pytest_terminal_summary
+        # brings it up to date
+        (
+            tally_session.lastline,
+            tally_session.lastline_ansi,
+        ) = build_lastline(
+            tally_session, session.config.pluginmanager.get_plugin("terminalreporter")
+        )
+        self.write_event(
+            "lastline",
+            lastline=tally_session.lastline,
+            lastline_ansi=tally_session.lastline_ansi,
+        )
+        self.write_event(
+            "session_finish",
+            exitstatus=int(exitstatus),
+            session_duration=tally_session.session_duration,
+        )
+        self.stop_flusher()
+        if self.database is not None:
+            self.database.finish_session(
+                self.database_session_id,
+                finished_at=time.time(),
+                session_duration=tally_session.session_duration,
+                num_tests_to_run=tally_session.num_tests_to_run,
+                num_tests_have_run=tally_session.num_tests_have_run,
+                exitstatus=int(exitstatus),
+                lastline=tally_session.lastline,
+            )
+
+    def pytest_terminal_summary(self, terminalreporter) -> None:
+        # Runs after pytest_sessionfinish (and the final publish), with the
+        # summary line pytest is about to print; republish only if it differs
+        tally_session = self.tally_session
+        lastline, lastline_ansi = build_lastline(tally_session, terminalreporter)
+        if lastline == tally_session.lastline:
             return
+        tally_session.lastline = lastline
+        tally_session.lastline_ansi = lastline_ansi
+        self.write_event("lastline", lastline=lastline, lastline_ansi=lastline_ansi)
+        self.flush()
+        if self.database is not None:
+            self.database.update_lastline(self.database_session_id, lastline)
+
+
+def update_tally_test(
+    tally_test: TallyTest,
+    tally_report: TallyReport,
+    outcome: str,
+    table: MmapStatusTable = None,
+) -> None:
+    if tally_test.test_outcome:
+        return
 
+    if tally_report.when == "setup" and outcome in ["error", "skipped"]:
+        tally_test.test_outcome = outcome.capitalize()
+        if table is not None:
+            table.set_outcome(tally_test.node_id, outcome)
+        return
 
-def pytest_sessionfinish(session: Session, exitstatus: ExitCode) -> None:
-    # This called after whole test run finished, right before returning the exit status to the system.
-    if not check_tally_enabled(session.config):
+    if tally_report.when == "call":
+        tally_test.test_outcome = outcome.capitalize()
+        if table is not None:
+            table.set_outcome(tally_test.node_id, outcome)
         return
 
-    session_config = session.config
-    pytest_tally_session = session_config.stash["pytest_tally_session"]
 
-    pytest_tally_session.timer.pause()
-    pytest_tally_session.session_duration = pytest_tally_session.timer.elapsed
-    pytest_tally_session.session_finished = True
-    write_json_to_file(session.config)
+def build_lastline(
+    pytest_tally_session: TallySession, terminalreporter=None
+) -> Tuple[str, str]:
+    # Rebuild pytest's final "N passed, M failed in X.XXs" line (plain and with
+    # ANSI colors) from the terminal reporter's parts and main color, rather
+    # than scraping it from the terminal output. Without a terminal reporter
+    # it is built from the plugin's own outcome counts.
+    if terminalreporter is not None:
+        summary_parts, main_color = terminalreporter.build_summary_stats_line()
+        parts = [
+            (text, next((k for k, on in markup.items() if on and k != "bold"), ""))
+            for text, markup in summary_parts
+        ]
+    else:
+        parts, main_color = build_summary_parts(pytest_tally_session)
+
+    seconds = pytest_tally_session.session_duration
+    duration = f"{seconds:.2f}s"
+    if seconds >= 60:
+        duration += f" ({datetime.timedelta(seconds=int(seconds))})"
+
+    lastline = ", ".join(text for text, _ in parts) + f" in {duration}"
+    lastline_ansi = (
+        ", ".join(
+            ANSI_CODES.get(color, "")
+            + (ANSI_BOLD if color == main_color else "")
+            + text
+            + ANSI_RESET
+            for text, color in parts
+        )
+        + f"{ANSI_CODES.get(main_color, '')} in {duration}{ANSI_RESET}"
+    )
+    return lastline, lastline_ansi
+
+
+def build_summary_parts(
+    pytest_tally_session: TallySession,
+) -> Tuple[List[Tuple[str, str]], str]:
+    with pytest_tally_session.lock:
+        counts = Counter(pytest_tally_session.outcome_counts)
+
+    parts = []
+    for outcome, color in LASTLINE_OUTCOMES:
+        count = counts[outcome]
+        if not count:
+            continue
+        noun = "errors" if outcome == "error" and count != 1 else outcome
+        parts.append((f"{count} {noun}", color))
+    if not parts:
+        parts.append(("no tests ran", "yellow"))
+
+    if counts["failed"] or counts["error"]:
+        main_color = "red"
+    elif any(color == "yellow" for _, color in parts):
+        main_color = "yellow"
+    else:
+        main_color = "green"
+    return parts, main_color
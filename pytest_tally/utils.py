@@ -1,8 +1,118 @@
+import array
+import datetime
 import fcntl
+import hashlib
 import json
+import logging
+import mmap
 import os
+import socket
+import sqlite3
+import stat
+import struct
+import tempfile
+import threading
+import time
+from collections import deque
 from pathlib import Path
-from typing import Any, Dict
+from typing import Any, Callable, Dict, List, Set, TextIO, Tuple
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - optional dependency
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+# Binary codecs prefix their payload with this magic, followed by the codec name
+# and a newline. A json document can never start with a NUL byte, so json files
+# written by older versions (or by the json-family codecs) need no header at all.
+TALLY_MAGIC = b"\x00TALLY:"
+
+# Seconds after its mtime from which a data file's fingerprint is trusted: more
+# than the coarsest common timestamp granularity (2 s on FAT)
+READER_RACY_TIME = 2.5
+
+# Layout of the memory-mapped status table used by --tally-format=mmap: a fixed
+# header followed by one fixed-size record per collected test, in collection
+# order. Records hold state, outcome code, start/stop wall-clock timestamps (ns)
+# and the setup/call/teardown durations (s).
+TABLE_MAGIC = b"TALLYMM1"
+TABLE_HEADER = struct.Struct("<8sIIQ")
+TABLE_RECORD = struct.Struct("<BBxxxxxxqqddd")
+TABLE_PHASES = ("setup", "call", "teardown")
+STATE_PENDING, STATE_RUNNING, STATE_FINISHED = 0, 1, 2
+OUTCOME_CODES = {
+    None: 0,
+    "passed": 1,
+    "failed": 2,
+    "error": 3,
+    "skipped": 4,
+    "xfailed": 5,
+    "xpassed": 6,
+}
+
+# Framing used by --tally-socket: every message is a 4-byte big-endian length
+# followed by that many bytes of compact json. A subscriber that falls more than
+# SOCKET_MAX_PENDING messages behind has its backlog replaced by a fresh snapshot.
+SOCKET_FRAME = struct.Struct(">I")
+SOCKET_MAX_PENDING = 1024
+SOCKET_RECONNECT_TIME = 0.5
+# Longest AF_UNIX socket path (sun_path is 108 bytes on Linux and 104 on macOS,
+# including the terminating NUL)
+SOCKET_PATH_MAX = 103
+
+# Schema of the SQLite database written by --tally-db. Sessions accumulate
+# across runs; tests and their phase reports are keyed by session. The indexes
+# cover the queries the clients make: one outcome in node ID order or slowest
+# first, and node IDs under a prefix (a range scan on the primary key).
+DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id INTEGER PRIMARY KEY,
+    started_at REAL NOT NULL,
+    finished_at REAL,
+    session_duration REAL,
+    num_tests_to_run INTEGER,
+    num_tests_have_run INTEGER,
+    exitstatus INTEGER,
+    lastline TEXT
+);
+CREATE TABLE IF NOT EXISTS tests (
+    session_id INTEGER NOT NULL REFERENCES sessions (session_id),
+    node_id TEXT NOT NULL,
+    test_outcome TEXT,
+    test_duration REAL,
+    started_at REAL,
+    finished_at REAL,
+    worker_id TEXT,
+    PRIMARY KEY (session_id, node_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS reports (
+    session_id INTEGER NOT NULL,
+    node_id TEXT NOT NULL,
+    phase TEXT NOT NULL,
+    outcome TEXT,
+    duration REAL,
+    PRIMARY KEY (session_id, node_id, phase)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS tests_outcome ON tests (session_id, test_outcome, test_duration);
+CREATE INDEX IF NOT EXISTS tests_outcome_node_id ON tests (session_id, test_outcome, node_id);
+CREATE INDEX IF NOT EXISTS tests_duration ON tests (session_id, test_duration);
+"""
+DB_SORT_COLUMNS = {"duration": "test_duration DESC", "node_id": "node_id"}
+
+# Layout of the per-node-id duration history: magic and record count, the
+# exponentially weighted mean durations (s) as a native array of doubles, then
+# the node IDs, newline-separated, in the same order. Loading is two bulk reads
+# rather than one parse per entry.
+HISTORY_MAGIC = b"TALLYH01"
+HISTORY_HEADER = struct.Struct("<8sQ")
+HISTORY_ALPHA = 0.3
 
 
 def clear_file(filename: Path) -> None:
@@ -10,6 +120,181 @@ def clear_file(filename: Path) -> None:
         jfile.write("")
 
 
+def format_eta(eta: float) -> str:
+    """Render the session's 'eta' (seconds, or None) for display in a client"""
+    if eta is None:
+        return ""
+    return f"ETA {datetime.timedelta(seconds=round(eta))}"
+
+
+def current_rates(rates: Dict[str, Any], now: float = None) -> Dict[str, Any]:
+    """
+    Evaluate the session's 'rates' at wall-clock time `now` (default: the
+    current time, but no later than the end of the session) from the window's
+    buckets, so that the rates keep falling while no test finishes without the
+    plugin rewriting the data file
+    """
+    if now is None:
+        now = time.time()
+    if rates.get("finished_at") is not None:
+        now = min(now, rates["finished_at"])
+    window = rates["window"]
+    elapsed = max(0.0, now - rates["started_at"])
+    second = int(now)
+    totals = [0] * (len(rates["outcomes"]) + 1)
+    for stamp, counts in rates["buckets"]:
+        if second - window < stamp <= second:
+            totals = [a + b for a, b in zip(totals, counts)]
+    # The window covers the full buckets before the current one plus the part
+    # of the current second that has gone by
+    span = min(elapsed, window - 1 + (now - second))
+    return dict(
+        rates,
+        tests_per_sec=sum(totals) / span if span > 0 else 0.0,
+        overall_tests_per_sec=rates["num_finished"] / elapsed if elapsed > 0 else 0.0,
+        outcomes_per_sec={
+            outcome: count / span if span > 0 else 0.0
+            for outcome, count in zip(rates["outcomes"], totals)
+        },
+    )
+
+
+def format_rates(rates: Dict[str, Any]) -> str:
+    """Render the session's 'rates' (or None) for display in a client"""
+    if not rates:
+        return ""
+    # Data files written by older plugins only have the rates as published
+    if "buckets" in rates:
+        rates = current_rates(rates)
+    text = (
+        f"{rates['tests_per_sec']:.1f} tests/s (last {rates['window']}s),"
+        f" {rates['overall_tests_per_sec']:.1f} tests/s overall"
+    )
+    outcomes = ", ".join(
+        f"{outcome} {rate:.1f}/s"
+        for outcome, rate in rates["outcomes_per_sec"].items()
+        if rate
+    )
+    return f"{text} [{outcomes}]" if outcomes else text
+
+
+class TallyCodec:
+    """
+    Base class for the encoders used to serialize tally data to bytes
+
+    Subclasses implement dumps/loads; encode adds the codec header for binary
+    codecs, and decode_tally_data picks the right codec when reading.
+
+    Attributes:
+        name (str): Name used to select the codec via --tally-codec
+        binary (bool): Whether the payload needs a header to be recognized
+    """
+
+    name: str = ""
+    binary: bool = False
+
+    def is_available(self) -> bool:
+        return True
+
+    def dumps(self, data: Dict[str, Any]) -> bytes:
+        raise NotImplementedError
+
+    def loads(self, raw: bytes) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def encode(self, data: Dict[str, Any]) -> bytes:
+        if self.binary:
+            return TALLY_MAGIC + self.name.encode() + b"\n" + self.dumps(data)
+        return self.dumps(data)
+
+
+class JsonCodec(TallyCodec):
+    """Indented stdlib json; the original (human-readable) data file format"""
+
+    name = "json"
+
+    def dumps(self, data: Dict[str, Any]) -> bytes:
+        return json.dumps(data, indent=4).encode()
+
+    def loads(self, raw: bytes) -> Dict[str, Any]:
+        return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+
+class CompactJsonCodec(JsonCodec):
+    """Minified stdlib json, without any insignificant whitespace"""
+
+    name = "compact"
+
+    def dumps(self, data: Dict[str, Any]) -> bytes:
+        return json.dumps(data, separators=(",", ":")).encode()
+
+
+class OrjsonCodec(JsonCodec):
+    """Minified json produced by orjson (optional dependency)"""
+
+    name = "orjson"
+
+    def is_available(self) -> bool:
+        return orjson is not None
+
+    def dumps(self, data: Dict[str, Any]) -> bytes:
+        return orjson.dumps(data)
+
+
+class MsgpackCodec(TallyCodec):
+    """Binary MessagePack (optional dependency)"""
+
+    name = "msgpack"
+    binary = True
+
+    def is_available(self) -> bool:
+        return msgpack is not None
+
+    def dumps(self, data: Dict[str, Any]) -> bytes:
+        return msgpack.packb(data)
+
+    def loads(self, raw: bytes) -> Dict[str, Any]:
+        try:
+            return msgpack.unpackb(raw)
+        except Exception as e:
+            raise ValueError(f"Invalid msgpack tally data: {e}") from e
+
+
+TALLY_CODECS: Dict[str, TallyCodec] = {
+    codec.name: codec
+    for codec in (JsonCodec(), CompactJsonCodec(), OrjsonCodec(), MsgpackCodec())
+}
+
+
+def get_codec(name: str) -> TallyCodec:
+    try:
+        codec = TALLY_CODECS[name]
+    except KeyError:
+        raise ValueError(
+            f"Unknown tally codec '{name}' (choose from {', '.join(TALLY_CODECS)})"
+        )
+    if not codec.is_available():
+        raise ValueError(
+            f"Tally codec '{name}' requires the '{name}' package to be installed"
+        )
+    return codec
+
+
+def decode_tally_data(raw: bytes) -> Dict[str, Any]:
+    """
+    Decode the contents of a tally data file, auto-detecting the codec
+
+    Raises ValueError if the data cannot be decoded. Empty input decodes to {}.
+    """
+    if not raw:
+        return {}
+    if raw.startswith(TALLY_MAGIC):
+        header, _, payload = raw.partition(b"\n")
+        codec = get_codec(header[len(TALLY_MAGIC) :].decode())
+        return codec.loads(payload)
+    return TALLY_CODECS["json"].loads(raw)
+
+
 class LocakbleJsonFileUtils:
     """
     Class to handle locking and reading/writing to a json file
@@ -32,19 +317,21 @@ class LocakbleJsonFileUtils:
 
     def __init__(self, file_path: Path):
         assert isinstance(file_path, Path), f"File {file_path} must be a Path object"
-        assert file_path.exists(), f"File {file_path} must exist"
         assert file_path.suffix == ".json", f"File {file_path} must be a json file"
         self.file_path: Path = file_path
         self.file: Any = None
 
     def _acquire_read_lock(self):
         os.makedirs(self.file_path.parent, exist_ok=True)
-        self.file = open(self.file_path, "r")
+        self.file = open(self.file_path, "rb")
         fcntl.flock(self.file, fcntl.LOCK_SH)
 
     def _acquire_overwrite_lock(self):
         os.makedirs(self.file_path.parent, exist_ok=True)
-        self.file = open(self.file_path, "w")
+        # Created if missing but not truncated: readers holding a shared lock
+        # must not see the file emptied before the exclusive lock is granted
+        fd = os.open(self.file_path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.file = os.fdopen(fd, "r+b")
         fcntl.flock(self.file, fcntl.LOCK_EX)
 
     def _acquire_append_lock(self):
@@ -58,23 +345,27 @@ class LocakbleJsonFileUtils:
         self.file = None
 
     def read_json(self):
-        self._acquire_read_lock()
         try:
-            data = json.load(self.file)
-        except json.decoder.JSONDecodeError:
-            data = {}
+            self._acquire_read_lock()
         except FileNotFoundError:
-            os.makedirs(self.file_path.parent, exist_ok=True)
+            return {}
+        try:
+            data = decode_tally_data(self.file.read())
+        except ValueError:
             data = {}
         finally:
             self._release_lock()
         return data
 
-    def overwrite_json(self, data: Dict[str, Any]):
+    def overwrite_json(self, data: Dict[str, Any], codec: TallyCodec = None):
+        codec = codec or TALLY_CODECS["json"]
+        self.overwrite_bytes(codec.encode(data))
+
+    def overwrite_bytes(self, raw: bytes):
         self._acquire_overwrite_lock()
         try:
             self.file.seek(0)
-            json.dump(data, self.file, indent=4)
+            self.file.write(raw)
             self.file.truncate()
         finally:
             self._release_lock()
@@ -87,3 +378,1038 @@ class LocakbleJsonFileUtils:
             self.file.truncate()
         finally:
             self._release_lock()
+
+
+class AtomicJsonFileUtils:
+    """
+    Class to publish a json file atomically, so that it can be read without locks
+
+    The data is written to a temporary sibling of the target file, which is then
+    moved over the target with os.replace. Readers therefore always see either
+    the previous or the new document, never an empty or partial one. Reads take
+    a shared file lock, which is never contended by atomic publishes but waits
+    for a writer rewriting the file in place (--tally-publish=lock).
+
+    __init__ Args:
+        file_path (Path): Path to the json file
+
+    Public Methods:
+        read_bytes: Read the raw contents of the json file (b"" if missing)
+        read_json: Read the json file and return the data
+        overwrite_json: Atomically replace the json file with the data
+        overwrite_bytes: Atomically replace the json file with encoded data
+
+    Example:
+        >>> utils = AtomicJsonFileUtils(Path("test.json"))
+        >>> utils.overwrite_json({"test": "test"})
+        >>> utils.read_json()
+        => {'test': 'test'}
+    """
+
+    def __init__(self, file_path: Path):
+        assert isinstance(file_path, Path), f"File {file_path} must be a Path object"
+        assert file_path.suffix == ".json", f"File {file_path} must be a json file"
+        self.file_path: Path = file_path
+
+    def read_bytes(self) -> bytes:
+        try:
+            with open(self.file_path, "rb") as file:
+                fcntl.flock(file, fcntl.LOCK_SH)
+                return file.read()
+        except FileNotFoundError:
+            return b""
+
+    def read_json(self):
+        try:
+            return decode_tally_data(self.read_bytes())
+        except ValueError:
+            return {}
+
+    def overwrite_json(self, data: Dict[str, Any], codec: TallyCodec = None):
+        codec = codec or TALLY_CODECS["json"]
+        self.overwrite_bytes(codec.encode(data))
+
+    def overwrite_bytes(self, raw: bytes):
+        os.makedirs(self.file_path.parent, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(
+            dir=self.file_path.parent, prefix=f".{self.file_path.name}.", suffix=".tmp"
+        )
+        try:
+            # mkstemp creates the file private to the user; keep the target's mode
+            try:
+                mode = stat.S_IMODE(os.stat(self.file_path).st_mode)
+            except FileNotFoundError:
+                mode = 0o644
+            os.chmod(tmp_path, mode)
+            with os.fdopen(fd, "wb") as file:
+                file.write(raw)
+            os.replace(tmp_path, self.file_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+class CachedJsonFileReader:
+    """
+    Class to read a tally data file, parsing it again only when it has changed
+
+    Before each read the file is fingerprinted by (inode, size, mtime) with a
+    single stat call. If the fingerprint matches the one of the last parse, the
+    data parsed then is returned as is; otherwise the file is read and parsed
+    again. The fingerprint alone is not proof of unchanged data: a rewrite in
+    place (--tally-publish=lock) of the same size within one mtime granule, or
+    an atomic publish that gets a recycled inode, keeps it. So, as git does for
+    its index, a fingerprint is only trusted once the file was read at least
+    READER_RACY_TIME after its mtime; until then the raw bytes are read and
+    compared with those of the last parse (by digest), which is still much
+    cheaper than parsing. The returned dict is shared between reads and must
+    not be modified.
+
+    __init__ Args:
+        file_path (Path): Path to the json file
+
+    Public Methods:
+        read_json: Return the parsed data, from cache if the file is unchanged
+        read_versioned: Return the generation along with the parsed data
+        fingerprint: Return the file's (inode, size, mtime_ns), or None
+
+    Attributes:
+        hits (int): Number of reads answered from the cache
+        misses (int): Number of reads that parsed the file
+        generation (int): Incremented each time the file is parsed, so it
+            identifies the data read
+
+    Example:
+        >>> reader = CachedJsonFileReader(Path("tally-data.json"))
+        >>> reader.read_json()
+        => {'session_started': True, ...}
+        >>> reader.read_json()  # file unchanged: not parsed again
+        >>> reader.hits, reader.misses
+        => (1, 1)
+    """
+
+    def __init__(self, file_path: Path):
+        self.file_utils = AtomicJsonFileUtils(file_path=file_path)
+        self.file_path: Path = file_path
+        self.hits: int = 0
+        self.misses: int = 0
+        self.generation: int = 0
+        self.lock = threading.Lock()
+        # Fingerprint, digest of the raw bytes and time of the last read, and
+        # the data parsed from them
+        self._cached: Tuple[Tuple[int, int, int], bytes, float, Dict[str, Any]] = (
+            None,
+            None,
+            0.0,
+            {},
+        )
+
+    def fingerprint(self) -> Tuple[int, int, int]:
+        try:
+            st = os.stat(self.file_path)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_size, st.st_mtime_ns
+
+    def read_json(self) -> Dict[str, Any]:
+        return self.read_versioned()[1]
+
+    def read_versioned(self) -> Tuple[int, Dict[str, Any]]:
+        with self.lock:
+            fingerprint = self.fingerprint()
+            cached_fingerprint, digest, read_at, data = self._cached
+            unchanged = fingerprint is not None and fingerprint == cached_fingerprint
+            if unchanged and read_at - fingerprint[2] / 1e9 >= READER_RACY_TIME:
+                self.hits += 1
+                return self.generation, data
+            # Stat before reading: if the file is replaced in between, the next
+            # fingerprint differs from the stored one and the file is re-read
+            read_at = time.time()
+            raw = self.file_utils.read_bytes()
+            raw_digest = hashlib.blake2b(raw, digest_size=16).digest()
+            if unchanged and raw_digest == digest:
+                self.hits += 1
+                self._cached = (fingerprint, digest, read_at, data)
+                return self.generation, data
+            self.misses += 1
+            self.generation += 1
+            try:
+                data = decode_tally_data(raw)
+            except ValueError:
+                data = {}
+            self._cached = (fingerprint, raw_digest, read_at, data)
+            return self.generation, data
+
+
+class NdjsonEventLog:
+    """
+    Class to append newline-delimited json records to an event log file
+
+    Each record is written as a single compact line, so the cost of an append
+    does not depend on how many records came before it.
+
+    __init__ Args:
+        file_path (Path): Path to the event log file (truncated on open)
+
+    Public Methods:
+        append: Append a single record to the log
+        close: Close the underlying file
+
+    Example:
+        >>> log = NdjsonEventLog(Path("tally-data.ndjson"))
+        >>> log.append({"event": "session_start"})
+        >>> log.close()
+    """
+
+    def __init__(self, file_path: Path):
+        assert isinstance(file_path, Path), f"File {file_path} must be a Path object"
+        os.makedirs(file_path.parent, exist_ok=True)
+        self.file_path: Path = file_path
+        self.file: TextIO = open(self.file_path, "w", buffering=1, encoding="utf-8")
+
+    def append(self, record: Dict[str, Any]):
+        if self.file is None:
+            return
+        self.file.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class BackgroundFlusher:
+    """
+    Class to run a flush callback on a daemon thread, coalescing requests
+
+    Callers only mark the data as dirty; the thread calls the flush callback at
+    most once per interval, however many times it was marked in between.
+
+    __init__ Args:
+        flush (Callable): Callback that writes out the current data
+        interval (float): Minimum number of seconds between two flushes
+
+    Public Methods:
+        start: Start the daemon thread
+        mark_dirty: Request a flush at the next opportunity
+        stop: Stop the thread and make a final synchronous flush
+
+    Example:
+        >>> flusher = BackgroundFlusher(flush=lambda: print("flush"), interval=0.05)
+        >>> flusher.start()
+        >>> flusher.mark_dirty()
+        >>> flusher.stop()
+        => flush
+    """
+
+    def __init__(self, flush: Callable[[], None], interval: float):
+        self.flush: Callable[[], None] = flush
+        self.interval: float = interval
+        self._dirty = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="tally-flusher", daemon=True
+        )
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._dirty.wait()
+            if self._stopped.is_set():
+                break
+            self._dirty.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Background flush failed")
+            self._stopped.wait(self.interval)
+
+    def start(self):
+        self._thread.start()
+
+    def mark_dirty(self):
+        self._dirty.set()
+
+    def stop(self, final_flush: bool = True):
+        if not self._stopped.is_set():
+            self._stopped.set()
+            self._dirty.set()
+            if self._thread.is_alive():
+                self._thread.join()
+        if final_flush:
+            self.flush()
+
+
+class MmapStatusTable:
+    """
+    Class to write and read the memory-mapped, fixed-slot test status table
+
+    The plugin creates the table once the number of collected tests is known,
+    after which every test update is an in-place write of a few bytes. Readers
+    map the same file read-only and count states/outcomes with strided slices,
+    without decoding the records one at a time. Node IDs are kept in a separate
+    newline-separated string table next to the status table.
+
+    __init__ Args:
+        file_path (Path): Path to the status table file
+        writable (bool): Map the file for writing (plugin) or reading (clients)
+
+    Public Methods:
+        create: Create a new table for the given node IDs and open it for writing
+        start_test: Mark a test as running
+        set_phase_duration: Record the duration of a setup/call/teardown phase
+        set_outcome: Record the outcome of a test
+        finish_test: Mark a test as finished
+        is_stale: Whether the file was replaced since it was opened
+        counts: Count running/finished tests and each outcome
+        digest: Hash of every test's state and outcome, to detect changes
+        tally_tests: Rebuild the tally_tests mapping of the json session data
+        close: Unmap the file
+
+    Example:
+        >>> table = MmapStatusTable.create(Path("tally-data.mmap"), ["test_a"])
+        >>> table.start_test("test_a")
+        >>> table.set_outcome("test_a", "passed")
+        >>> table.finish_test("test_a")
+        >>> MmapStatusTable(Path("tally-data.mmap")).counts()
+        => {'running': 0, 'finished': 1, 'outcomes': {'passed': 1, ...}}
+    """
+
+    def __init__(self, file_path: Path, writable: bool = False):
+        assert isinstance(file_path, Path), f"File {file_path} must be a Path object"
+        self.file_path: Path = file_path
+        with open(self.file_path, "r+b" if writable else "rb") as file:
+            self.inode: int = os.fstat(file.fileno()).st_ino
+            self.mm = mmap.mmap(
+                file.fileno(),
+                0,
+                access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ,
+            )
+        magic, _, record_size, num_records = TABLE_HEADER.unpack_from(self.mm, 0)
+        assert magic == TABLE_MAGIC, f"File {file_path} is not a tally status table"
+        assert record_size == TABLE_RECORD.size, f"Unsupported table in {file_path}"
+        self.num_records: int = num_records
+        self.node_ids: List[str] = (
+            self.node_ids_path(file_path)
+            .read_text(encoding="utf-8")
+            .split("\n")[:num_records]
+        )
+        self.index: Dict[str, int] = {}
+        if writable:
+            self.index = {node_id: i for i, node_id in enumerate(self.node_ids)}
+
+    @staticmethod
+    def node_ids_path(file_path: Path) -> Path:
+        return file_path.with_suffix(".nodeids")
+
+    @classmethod
+    def create(cls, file_path: Path, node_ids: List[str]) -> "MmapStatusTable":
+        # Both files are written under temporary names and moved into place, so
+        # a reader never maps a half-initialized table
+        os.makedirs(file_path.parent, exist_ok=True)
+        ids_path = cls.node_ids_path(file_path)
+        tmp_ids = ids_path.with_name(f".{ids_path.name}.tmp")
+        tmp_ids.write_text("\n".join(node_ids), encoding="utf-8")
+        os.replace(tmp_ids, ids_path)
+
+        tmp_table = file_path.with_name(f".{file_path.name}.tmp")
+        with open(tmp_table, "wb") as file:
+            file.write(
+                TABLE_HEADER.pack(TABLE_MAGIC, 1, TABLE_RECORD.size, len(node_ids))
+            )
+            file.truncate(TABLE_HEADER.size + TABLE_RECORD.size * len(node_ids))
+        os.replace(tmp_table, file_path)
+        return cls(file_path, writable=True)
+
+    def _offset(self, node_id: str) -> int:
+        return TABLE_HEADER.size + TABLE_RECORD.size * self.index[node_id]
+
+    def start_test(self, node_id: str):
+        offset = self._offset(node_id)
+        struct.pack_into("<B", self.mm, offset, STATE_RUNNING)
+        struct.pack_into("<q", self.mm, offset + 8, time.time_ns())
+
+    def set_phase_duration(self, node_id: str, when: str, duration: float):
+        offset = self._offset(node_id) + 24 + 8 * TABLE_PHASES.index(when)
+        struct.pack_into("<d", self.mm, offset, duration)
+
+    def set_outcome(self, node_id: str, outcome: str):
+        offset = self._offset(node_id) + 1
+        struct.pack_into("<B", self.mm, offset, OUTCOME_CODES.get(outcome, 0))
+
+    def finish_test(self, node_id: str):
+        offset = self._offset(node_id)
+        struct.pack_into("<q", self.mm, offset + 16, time.time_ns())
+        struct.pack_into("<B", self.mm, offset, STATE_FINISHED)
+
+    def is_stale(self) -> bool:
+        try:
+            return os.stat(self.file_path).st_ino != self.inode
+        except FileNotFoundError:
+            return True
+
+    def _column(self, offset: int) -> bytes:
+        start = TABLE_HEADER.size + offset
+        stop = TABLE_HEADER.size + TABLE_RECORD.size * self.num_records
+        return self.mm[start : stop : TABLE_RECORD.size]
+
+    def counts(self) -> Dict[str, Any]:
+        states = self._column(0)
+        outcomes = self._column(1)
+        return {
+            "running": states.count(STATE_RUNNING),
+            "finished": states.count(STATE_FINISHED),
+            "outcomes": {
+                outcome: outcomes.count(code)
+                for outcome, code in OUTCOME_CODES.items()
+                if outcome is not None
+            },
+        }
+
+    def digest(self) -> bytes:
+        # Phase durations are written before a test is marked finished, so the
+        # state and outcome columns change whenever anything shown does
+        digest = hashlib.blake2b(self._column(0), digest_size=16)
+        digest.update(self._column(1))
+        return digest.digest()
+
+    def tally_tests(self) -> Dict[str, Dict[str, Any]]:
+        outcome_names = {code: outcome for outcome, code in OUTCOME_CODES.items()}
+        tally_tests = {}
+        records = TABLE_RECORD.iter_unpack(
+            self.mm[
+                TABLE_HEADER.size : TABLE_HEADER.size
+                + TABLE_RECORD.size * self.num_records
+            ]
+        )
+        for node_id, record in zip(self.node_ids, records):
+            state, outcome, start_ns, stop_ns, *durations = record
+            if state == STATE_PENDING:
+                continue
+            outcome = outcome_names.get(outcome)
+            duration = sum(durations)
+            tally_tests[node_id] = {
+                "node_id": node_id,
+                "test_duration": duration,
+                "test_outcome": outcome.capitalize() if outcome else None,
+                "timer": {
+                    "elapsed": duration,
+                    "running": state == STATE_RUNNING,
+                    "finished": state == STATE_FINISHED,
+                },
+                "phases": dict(zip(TABLE_PHASES, durations)),
+                "reports": {},
+            }
+        return tally_tests
+
+    def close(self):
+        if not self.mm.closed:
+            self.mm.close()
+
+
+def socket_path_for(file_path: Path) -> Path:
+    """
+    Path of the --tally-socket socket for a data file: next to it with a '.sock'
+    suffix, or, if that path is too long for AF_UNIX (deep CI workspaces), a
+    short one in the temp directory named after a hash of it. The plugin and
+    the clients derive it the same way from the data file's absolute path.
+    """
+    socket_path = file_path.resolve().with_suffix(".sock")
+    if len(os.fsencode(socket_path)) <= SOCKET_PATH_MAX:
+        return socket_path
+    digest = hashlib.blake2b(os.fsencode(socket_path), digest_size=8).hexdigest()
+    return Path(tempfile.gettempdir()) / f"tally-{digest}.sock"
+
+
+def encode_socket_frame(record: Dict[str, Any]) -> bytes:
+    payload = json.dumps(record, separators=(",", ":")).encode()
+    return SOCKET_FRAME.pack(len(payload)) + payload
+
+
+class TallySocketServer:
+    """
+    Class to push tally events to any number of clients over a Unix socket
+
+    Each connected client gets its own bounded queue and sender thread, so a
+    slow (or stuck) client never blocks the test process: once it is more than
+    max_pending messages behind, its backlog is dropped and replaced by a fresh
+    snapshot. Clients also get a snapshot as their first message, so they can
+    connect at any point during the session.
+
+    Records are numbered (seq). A snapshot is built by the client's sender
+    thread without holding the server's lock, so publish() never waits for
+    one; it carries the seq of the last record published before it was
+    started, and clients skip queued records up to that seq.
+
+    __init__ Args:
+        socket_path (Path): Path of the Unix domain socket to listen on
+        snapshot (Callable): Callback returning the current session, JSON-encoded
+        max_pending (int): Number of queued messages after which a client resyncs
+
+    Public Methods:
+        start: Bind the socket and start accepting clients
+        publish: Send a record to every connected client
+        has_clients: True if at least one client is connected
+        close: Disconnect all clients and remove the socket file
+
+    Example:
+        >>> server = TallySocketServer(Path("tally-data.sock"), snapshot=lambda: b"{}")
+        >>> server.start()
+        >>> server.publish({"event": "session_start"})
+        >>> server.close()
+    """
+
+    def __init__(
+        self,
+        socket_path: Path,
+        snapshot: Callable[[], bytes],
+        max_pending: int = SOCKET_MAX_PENDING,
+    ):
+        assert isinstance(
+            socket_path, Path
+        ), f"File {socket_path} must be a Path object"
+        self.socket_path: Path = socket_path
+        self.snapshot: Callable[[], bytes] = snapshot
+        self.max_pending: int = max_pending
+        self.clients: List[TallySocketClient] = []
+        self.seq: int = 0
+        # Numbers records in the order they are queued, and orders a resync's
+        # clearing of a client's queue against publish()
+        self.lock = threading.Lock()
+        self._listener: socket.socket = None
+        self._thread = threading.Thread(
+            target=self._accept, name="tally-socket", daemon=True
+        )
+
+    def start(self):
+        os.makedirs(self.socket_path.parent, exist_ok=True)
+        if self.socket_path.is_socket():
+            self.socket_path.unlink()
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(str(self.socket_path))
+        self._listener.listen()
+        self._thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self._listener.accept()
+            except OSError:
+                break
+            client = TallySocketClient(server=self, conn=conn)
+            with self.lock:
+                self.clients.append(client)
+            client.start()
+
+    def has_clients(self) -> bool:
+        return bool(self.clients)
+
+    def publish(self, record: Dict[str, Any]):
+        with self.lock:
+            self.seq += 1
+            frame = encode_socket_frame(dict(record, seq=self.seq))
+            for client in self.clients:
+                client.offer(frame)
+
+    def encode_snapshot(self, client: "TallySocketClient") -> bytes:
+        with self.lock:
+            client.pending.clear()
+            seq = self.seq
+        # Everything published up to seq is already in the session; records
+        # published while it is encoded are queued and applied after it
+        payload = b"".join(
+            (
+                b'{"event":"snapshot","seq":',
+                str(seq).encode(),
+                b',"ts":',
+                repr(time.time()).encode(),
+                b',"session":',
+                self.snapshot(),
+                b"}",
+            )
+        )
+        return SOCKET_FRAME.pack(len(payload)) + payload
+
+    def remove(self, client: "TallySocketClient"):
+        with self.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+
+    def close(self):
+        if self._listener is not None:
+            try:
+                self._listener.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._listener.close()
+            self._listener = None
+            if self._thread.is_alive():
+                self._thread.join()
+        for client in list(self.clients):
+            client.close()
+        self.clients = []
+        if self.socket_path.is_socket():
+            self.socket_path.unlink()
+
+
+class TallySocketClient:
+    """
+    Class for one connection accepted by TallySocketServer
+
+    offer() only appends to a bounded in-memory queue; a daemon thread does the
+    (possibly blocking) sends.
+
+    __init__ Args:
+        server (TallySocketServer): Server that accepted the connection
+        conn (socket.socket): Connected client socket
+
+    Public Methods:
+        start: Start the sender thread
+        offer: Queue a frame for sending, or flag a resync if the queue is full
+        close: Close the connection and stop the sender thread
+    """
+
+    def __init__(self, server: TallySocketServer, conn: socket.socket):
+        self.server: TallySocketServer = server
+        self.conn: socket.socket = conn
+        self.pending: deque = deque()
+        self.resync: bool = True
+        self.closed: bool = False
+        self._ready = threading.Condition()
+        self._thread = threading.Thread(
+            target=self._run, name="tally-socket-client", daemon=True
+        )
+
+    def start(self):
+        self._thread.start()
+
+    def offer(self, frame: bytes):
+        with self._ready:
+            if self.resync:
+                # The snapshot about to be sent supersedes this frame
+                return
+            if len(self.pending) >= self.server.max_pending:
+                self.pending.clear()
+                self.resync = True
+            else:
+                self.pending.append(frame)
+            self._ready.notify()
+
+    def _run(self):
+        try:
+            while True:
+                with self._ready:
+                    while not (self.pending or self.resync or self.closed):
+                        self._ready.wait()
+                    if self.closed:
+                        break
+                    resync, self.resync = self.resync, False
+                if resync:
+                    self.conn.sendall(self.server.encode_snapshot(self))
+                    continue
+                with self._ready:
+                    frames, self.pending = self.pending, deque()
+                self.conn.sendall(b"".join(frames))
+        except OSError:
+            pass
+        finally:
+            self.server.remove(self)
+            self.close()
+
+    def close(self):
+        with self._ready:
+            if self.closed:
+                return
+            self.closed = True
+            self._ready.notify()
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.conn.close()
+
+
+class TallySocketSubscriber:
+    """
+    Class to keep a local copy of the tally data pushed over --tally-socket
+
+    A daemon thread connects to the plugin's socket (retrying until it shows
+    up, and again if the session ends), applies each event to the local copy,
+    then calls the optional on_update callback. read_json() has the same
+    signature as the file utils' read_json(), so clients can use either.
+
+    __init__ Args:
+        socket_path (Path): Path of the Unix domain socket the plugin serves
+        on_update (Callable): Optional callback run after each applied event
+
+    Public Methods:
+        start: Start the receiving thread
+        read_json: Return a copy of the current tally data
+        close: Stop the receiving thread
+
+    Attributes:
+        sequence (int): Number of events applied so far; changes whenever the
+            local copy does
+        snapshot_seq (int): seq of the last snapshot; queued events up to it
+            are already part of it and skipped
+
+    Example:
+        >>> subscriber = TallySocketSubscriber(Path("tally-data.sock"))
+        >>> subscriber.start()
+        >>> data = subscriber.read_json()
+    """
+
+    def __init__(self, socket_path: Path, on_update: Callable[[], None] = None):
+        assert isinstance(
+            socket_path, Path
+        ), f"File {socket_path} must be a Path object"
+        self.socket_path: Path = socket_path
+        self.on_update: Callable[[], None] = on_update
+        self.data: Dict[str, Any] = {}
+        self.sequence: int = 0
+        self.snapshot_seq: int = 0
+        self.lock = threading.Lock()
+        self._closed = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="tally-subscriber", daemon=True
+        )
+
+    def start(self):
+        self._thread.start()
+
+    def read_json(self) -> Dict[str, Any]:
+        with self.lock:
+            if not self.data:
+                return {}
+            data = dict(self.data)
+            data["tally_tests"] = dict(data.get("tally_tests", {}))
+            return data
+
+    def apply(self, record: Dict[str, Any]):
+        # Events carry the session header and the full state of the test they
+        # are about, so applying one is idempotent; those the last snapshot
+        # already includes are skipped
+        with self.lock:
+            if record["event"] == "snapshot":
+                self.sequence += 1
+                self.data = record["session"]
+                self.snapshot_seq = record.get("seq", 0)
+                return
+            if record.get("seq", self.snapshot_seq + 1) <= self.snapshot_seq:
+                return
+            self.sequence += 1
+            if "session" in record:
+                self.data.update(record["session"])
+            if record.get("test"):
+                tally_tests = self.data.setdefault("tally_tests", {})
+                tally_tests[record["test"]["node_id"]] = record["test"]
+
+    def _run(self):
+        while not self._closed.is_set():
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+                    conn.connect(str(self.socket_path))
+                    stream = conn.makefile("rb")
+                    while not self._closed.is_set():
+                        header = stream.read(SOCKET_FRAME.size)
+                        if len(header) < SOCKET_FRAME.size:
+                            break
+                        (length,) = SOCKET_FRAME.unpack(header)
+                        self.apply(json.loads(stream.read(length)))
+                        if self.on_update is not None:
+                            self.on_update()
+            except OSError:
+                pass
+            self._closed.wait(SOCKET_RECONNECT_TIME)
+
+    def close(self):
+        self._closed.set()
+
+
+class TallyDatabase:
+    """
+    Class to record tally data into, and query it from, a SQLite database
+
+    The database is opened in WAL mode, so any number of clients can query it
+    while the plugin writes. The plugin only queues rows in memory; commit()
+    inserts everything queued since the previous call in a single transaction
+    (the plugin calls it from the same background flusher that writes the data
+    file).
+
+    __init__ Args:
+        file_path (Path): Path to the database file (created if missing)
+        writable (bool): Create the schema and accept writes (plugin)
+
+    Public Methods:
+        start_session: Insert a new session and return its ID
+        finish_session: Record the final state of a session
+        update_lastline: Replace the summary line of a session
+        record_report: Queue a setup/call/teardown report
+        record_test: Queue a finished test
+        commit: Insert all queued rows in one transaction
+        latest_session: Return the most recent session
+        tests: Query the tests of a session by outcome and/or node ID prefix
+        close: Commit (if writable) and close the connection
+
+    Example:
+        >>> db = TallyDatabase(Path("tally-data.db"), writable=True)
+        >>> session_id = db.start_session(time.time())
+        >>> db.record_test(session_id, "test_a", "passed", 0.1, 0.0, 0.1)
+        >>> db.commit()
+        >>> TallyDatabase(Path("tally-data.db")).tests(outcome="passed", limit=50)
+        => [{'node_id': 'test_a', 'test_outcome': 'passed', ...}]
+    """
+
+    def __init__(self, file_path: Path, writable: bool = False):
+        assert isinstance(file_path, Path), f"File {file_path} must be a Path object"
+        self.file_path: Path = file_path
+        self.writable: bool = writable
+        if writable:
+            os.makedirs(file_path.parent, exist_ok=True)
+        elif not file_path.is_file():
+            raise FileNotFoundError(f"File {file_path} does not exist")
+        # Writes come from the plugin's hooks and from its background flusher
+        self.conn = sqlite3.connect(
+            str(file_path), check_same_thread=False, isolation_level=None
+        )
+        self.conn.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        self._tests: List[tuple] = []
+        self._reports: List[tuple] = []
+        if writable:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.executescript(DB_SCHEMA)
+        # A database written by an older plugin may lack some of the indexes
+        self.indexes: Set[str] = {
+            name
+            for (name,) in self.conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index'"
+            )
+        }
+
+    def start_session(self, started_at: float) -> int:
+        with self.lock:
+            cursor = self.conn.execute(
+                "INSERT INTO sessions (started_at) VALUES (?)", (started_at,)
+            )
+            return cursor.lastrowid
+
+    def finish_session(
+        self,
+        session_id: int,
+        finished_at: float,
+        session_duration: float,
+        num_tests_to_run: int,
+        num_tests_have_run: int,
+        exitstatus: int,
+        lastline: str,
+    ):
+        self.commit()
+        with self.lock:
+            self.conn.execute(
+                (
+                    "UPDATE sessions SET finished_at = ?, session_duration = ?,"
+                    " num_tests_to_run = ?, num_tests_have_run = ?, exitstatus = ?,"
+                    " lastline = ? WHERE session_id = ?"
+                ),
+                (
+                    finished_at,
+                    session_duration,
+                    num_tests_to_run,
+                    num_tests_have_run,
+                    exitstatus,
+                    lastline,
+                    session_id,
+                ),
+            )
+
+    def update_lastline(self, session_id: int, lastline: str):
+        with self.lock:
+            self.conn.execute(
+                "UPDATE sessions SET lastline = ? WHERE session_id = ?",
+                (lastline, session_id),
+            )
+
+    def record_report(
+        self, session_id: int, node_id: str, phase: str, outcome: str, duration: float
+    ):
+        with self.lock:
+            self._reports.append((session_id, node_id, phase, outcome, duration))
+
+    def record_test(
+        self,
+        session_id: int,
+        node_id: str,
+        test_outcome: str,
+        test_duration: float,
+        started_at: float,
+        finished_at: float,
+        worker_id: str = None,
+    ):
+        with self.lock:
+            self._tests.append(
+                (
+                    session_id,
+                    node_id,
+                    test_outcome,
+                    test_duration,
+                    started_at,
+                    finished_at,
+                    worker_id,
+                )
+            )
+
+    def commit(self):
+        with self.lock:
+            tests, self._tests = self._tests, []
+            reports, self._reports = self._reports, []
+            if not tests and not reports:
+                return
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO tests VALUES (?, ?, ?, ?, ?, ?, ?)", tests
+                )
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO reports VALUES (?, ?, ?, ?, ?)", reports
+                )
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def latest_session(self) -> Dict[str, Any]:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT * FROM sessions ORDER BY session_id DESC LIMIT 1"
+            ).fetchone()
+        return dict(row) if row is not None else {}
+
+    def tests(
+        self,
+        session_id: int = None,
+        outcome: str = None,
+        prefix: str = None,
+        sort: str = "node_id",
+        limit: int = None,
+        offset: int = 0,
+    ) -> List[Dict[str, Any]]:
+        """
+        Query the tests of a session (the latest one by default); e.g. failures
+        only (outcome="failed"), the slowest 50 (sort="duration", limit=50) or
+        everything under a directory (prefix="tests/api/")
+        """
+        if sort not in DB_SORT_COLUMNS:
+            raise ValueError(
+                f"Unknown sort '{sort}'; expected one of {', '.join(DB_SORT_COLUMNS)}"
+            )
+        if session_id is None:
+            session_id = self.latest_session().get("session_id")
+        table = "tests"
+        if outcome and sort == "node_id" and "tests_outcome_node_id" in self.indexes:
+            # Without ANALYZE statistics SQLite prefers the primary key and
+            # filters every test of the session; the index is a range scan
+            table += " INDEXED BY tests_outcome_node_id"
+        query = f"SELECT * FROM {table} WHERE session_id = ?"
+        params: List[Any] = [session_id]
+        if outcome:
+            query += " AND test_outcome = ?"
+            params.append(outcome.lower())
+        if prefix:
+            # A range on the primary key rather than LIKE, so the index is used
+            query += " AND node_id >= ? AND node_id < ?"
+            params += [prefix, prefix + "\U0010ffff"]
+        query += f" ORDER BY {DB_SORT_COLUMNS[sort]} LIMIT ? OFFSET ?"
+        params += [-1 if limit is None else limit, offset]
+        with self.lock:
+            rows = self.conn.execute(query, params).fetchall()
+        return [dict(row) for row in rows]
+
+    def close(self):
+        if self.conn is None:
+            return
+        if self.writable:
+            self.commit()
+        self.conn.close()
+        self.conn = None
+
+
+class DurationHistory:
+    """
+    Class to keep a persistent, per-node-id history of test durations
+
+    Each node ID maps to an exponentially weighted mean of its past durations,
+    so one unusually slow (or fast) run does not throw the estimate off for
+    good. Node IDs that are not run in a session keep their history.
+
+    __init__ Args:
+        file_path (Path): Path to the history file (loaded if it exists)
+        alpha (float): Weight of the newest duration in the weighted mean
+
+    Public Methods:
+        load: (Re)load the history from file
+        get: Return the mean duration of a node ID, or a default
+        update: Fold a new duration into the mean of a node ID
+        save: Atomically write the history back to file
+
+    Example:
+        >>> history = DurationHistory(Path(".pytest_cache/d/tally/durations"))
+        >>> history.update("test_a", 1.5)
+        >>> history.save()
+        >>> DurationHistory(Path(".pytest_cache/d/tally/durations")).get("test_a")
+        => 1.5
+    """
+
+    def __init__(self, file_path: Path, alpha: float = HISTORY_ALPHA):
+        assert isinstance(file_path, Path), f"File {file_path} must be a Path object"
+        self.file_path: Path = file_path
+        self.alpha: float = alpha
+        self.durations: Dict[str, float] = {}
+        if file_path.is_file():
+            self.load()
+
+    def load(self):
+        raw = self.file_path.read_bytes()
+        try:
+            magic, count = HISTORY_HEADER.unpack_from(raw, 0)
+            if magic != HISTORY_MAGIC:
+                raise ValueError("bad magic")
+            means = array.array("d")
+            offset = HISTORY_HEADER.size
+            means.frombytes(raw[offset : offset + count * means.itemsize])
+            offset += count * means.itemsize
+            node_ids = raw[offset:].decode("utf-8").split("\n") if count else []
+            if len(means) != count or len(node_ids) != count:
+                raise ValueError("truncated")
+        except (ValueError, struct.error, UnicodeDecodeError) as e:
+            logger.warning(
+                f"Ignoring unreadable duration history {self.file_path}: {e}"
+            )
+            self.durations = {}
+            return
+        self.durations = dict(zip(node_ids, means))
+
+    def get(self, node_id: str, default: float = None) -> float:
+        return self.durations.get(node_id, default)
+
+    def update(self, node_id: str, duration: float):
+        mean = self.durations.get(node_id)
+        self.durations[node_id] = (
+            duration
+            if mean is None
+            else self.alpha * duration + (1 - self.alpha) * mean
+        )
+
+    def save(self):
+        means = array.array("d", self.durations.values())
+        raw = b"".join(
+            (
+                HISTORY_HEADER.pack(HISTORY_MAGIC, len(means)),
+                means.tobytes(),
+                "\n".join(self.durations).encode("utf-8"),
+            )
+        )
+        os.makedirs(self.file_path.parent, exist_ok=True)
+        tmp_path = self.file_path.with_name(f".{self.file_path.name}.tmp")
+        tmp_path.write_bytes(raw)
+        os.replace(tmp_path, self.file_path)
@@ -36,9 +36,12 @@ setup(
         "quantiphy==2.19",
         "rich==13.3.2",
         "single-source==0.3.0",
-        "strip-ansi==0.1.1",
         "watchdog==3.0.0",
     ],
+    extras_require={
+        "orjson": ["orjson"],
+        "msgpack": ["msgpack"],
+    },
     setup_requires=["setuptools_scm"],
     include_package_data=True,
     classifiers=[
@@ -0,0 +1,182 @@
+import json
+
+import pytest
+
+from pytest_tally.clients import app as tally_app
+from pytest_tally.utils import MmapStatusTable
+
+
+@pytest.fixture
+def client(tmp_path):
+    app = tally_app.app
+    for key in [key for key in app.config if key.startswith("TALLY_")]:
+        del app.config[key]
+    app.config["JSON_FILE_PATH"] = str(tmp_path / "tally-data.json")
+    yield app.test_client()
+    for key in [key for key in app.config if key.startswith("TALLY_")]:
+        del app.config[key]
+
+
+@pytest.fixture
+def mmap_run(tmp_path):
+    """A data file in 'mmap' mode: the tests live in the status table only"""
+    node_ids = [f"test_m.py::test_{i}" for i in range(5)]
+    table = MmapStatusTable.create(tmp_path / "tally-data.mmap", node_ids)
+    header = {"session_started": True, "tally_table": str(table.file_path)}
+    (tmp_path / "tally-data.json").write_text(json.dumps(header))
+    yield table
+    table.close()
+
+
+def run_test(table, node_id, outcome="passed"):
+    table.start_test(node_id)
+    table.set_outcome(node_id, outcome)
+    table.finish_test(node_id)
+
+
+def finished(results):
+    return [
+        node_id
+        for node_id, test in results["tally_tests"].items()
+        if test["timer"]["finished"]
+    ]
+
+
+def test_mmap_table_changes_reach_results_and_events(client, mmap_run):
+    feed = tally_app.get_feed()
+    run_test(mmap_run, "test_m.py::test_0")
+    assert finished(client.get("/results").get_json()) == ["test_m.py::test_0"]
+    feed.poll()
+    seq = feed.seq
+
+    # Only the status table changes; the data file stays as it is
+    run_test(mmap_run, "test_m.py::test_1", "failed")
+    assert finished(client.get("/results").get_json()) == [
+        "test_m.py::test_0",
+        "test_m.py::test_1",
+    ]
+    feed.poll()
+    assert feed.seq > seq
+    assert finished(feed.results) == ["test_m.py::test_0", "test_m.py::test_1"]
+
+
+def test_unchanged_mmap_results_are_not_modified(client, mmap_run):
+    run_test(mmap_run, "test_m.py::test_0")
+    etag = client.get("/results").headers["ETag"]
+    response = client.get("/results", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    run_test(mmap_run, "test_m.py::test_1")
+    response = client.get("/results", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+
+
+def test_paged_results_advance_during_mmap_run(client, mmap_run):
+    def newest():
+        return client.get("/results?sort=finish_order&limit=2").get_json()
+
+    run_test(mmap_run, "test_m.py::test_0")
+    page = newest()
+    assert page["total"] == 1
+    assert [test["node_id"] for test in page["tests"]] == ["test_m.py::test_0"]
+
+    run_test(mmap_run, "test_m.py::test_1")
+    mmap_run.start_test("test_m.py::test_2")
+    page = newest()
+    assert page["total"] == 3
+    # Running tests come first, then the most recently finished
+    assert [test["node_id"] for test in page["tests"]] == [
+        "test_m.py::test_2",
+        "test_m.py::test_1",
+    ]
+
+
+def make_test(node_id, duration, outcome):
+    running = outcome is None
+    return {
+        "node_id": node_id,
+        "test_duration": 0.0 if running else duration,
+        "test_outcome": None if running else outcome,
+        "timer": {"running": running, "finished": not running},
+    }
+
+
+def expected_page(tests, finish_order, sort, outcome, prefix):
+    running = [node_id for node_id in tests if tests[node_id]["timer"]["running"]]
+    if sort == "node_id":
+        order = sorted(tests)
+    elif sort == "duration":
+        done = [node_id for node_id in tests if node_id not in running]
+        order = sorted(done, key=lambda n: (-tests[n]["test_duration"], n))
+        order += running
+    else:
+        order = running[::-1] + finish_order[::-1]
+    return [
+        tests[node_id]
+        for node_id in order
+        if (not prefix or node_id.startswith(prefix))
+        and (
+            not outcome
+            or tally_app.ResultsIndex.outcome(tests[node_id]) == outcome.lower()
+        )
+    ]
+
+
+def test_results_index_matches_brute_force():
+    index = tally_app.ResultsIndex()
+    tests, finish_order = {}, []
+    outcomes = ["Passed", "Passed", "Failed", "Skipped"]
+    # A bulk first update, then small incremental ones: tests starting,
+    # finishing and finishing again
+    for i in range(200):
+        node_id = f"tests/m{i % 7}/test_x.py::test_{i}"
+        tests[node_id] = make_test(node_id, (i * 37 % 101) / 10, outcomes[i % 4])
+        finish_order.append(node_id)
+    index.update(dict(tests))
+    for i in range(200, 240):
+        node_id = f"tests/m{i % 7}/test_x.py::test_{i}"
+        tests[node_id] = make_test(node_id, 0.0, None)
+        index.update({node_id: tests[node_id]})
+        if i % 3:
+            tests[node_id] = make_test(node_id, (i * 13 % 97) / 10, outcomes[i % 4])
+            finish_order.append(node_id)
+            index.update({node_id: tests[node_id]})
+    rerun = "tests/m0/test_x.py::test_0"
+    tests[rerun] = make_test(rerun, 9.5, "Failed")
+    finish_order.remove(rerun)
+    finish_order.append(rerun)
+    index.update({rerun: tests[rerun]})
+
+    for sort in tally_app.RESULTS_SORTS:
+        for outcome in (None, "failed", "PASSED", "running", "xpassed"):
+            for prefix in (None, "tests/m3/", "tests/m1", "nope"):
+                expected = expected_page(tests, finish_order, sort, outcome, prefix)
+                for offset, limit in ((0, None), (0, 10), (25, 10), (len(expected), 5)):
+                    total, page = index.query(sort, outcome, prefix, offset, limit)
+                    stop = None if limit is None else offset + limit
+                    assert total == len(expected)
+                    assert page == expected[offset:stop], (sort, outcome, prefix)
+
+
+def test_paged_results_arguments(client, tmp_path):
+    tests = {
+        node_id: make_test(node_id, duration, outcome)
+        for node_id, duration, outcome in [
+            ("test_a.py::test_1", 0.5, "Passed"),
+            ("test_a.py::test_2", 2.0, "Failed"),
+            ("test_b.py::test_1", 1.0, "Passed"),
+        ]
+    }
+    header = {"session_started": True, "tally_tests": tests}
+    (tmp_path / "tally-data.json").write_text(json.dumps(header))
+
+    page = client.get("/results?sort=duration&outcome=passed&limit=1").get_json()
+    assert page["total"] == 2
+    assert [test["node_id"] for test in page["tests"]] == ["test_b.py::test_1"]
+    assert page["session"]["session_started"] is True
+
+    page = client.get("/results?prefix=test_a.py&offset=1").get_json()
+    assert [test["node_id"] for test in page["tests"]] == ["test_a.py::test_2"]
+
+    assert client.get("/results?sort=bogus").status_code == 400
+    assert client.get("/results?offset=-1").status_code == 400
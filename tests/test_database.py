@@ -0,0 +1,61 @@
+import sqlite3
+
+import pytest
+
+from pytest_tally.utils import TallyDatabase
+
+
+@pytest.fixture
+def database(tmp_path):
+    db = TallyDatabase(tmp_path / "tally-data.db", writable=True)
+    session_id = db.start_session(0.0)
+    for i in range(200):
+        outcome = "failed" if i % 7 == 0 else "passed"
+        db.record_test(session_id, f"tests/test_{i:03d}.py::test", outcome, i, 0, 1)
+    db.commit()
+    yield db
+    db.close()
+
+
+def traced_tests(db, **kwargs):
+    # Return the rows and the statement (with its arguments bound) tests() ran
+    statements = []
+    db.conn.set_trace_callback(statements.append)
+    rows = db.tests(**kwargs)
+    db.conn.set_trace_callback(None)
+    query = next(s for s in statements if s.startswith("SELECT * FROM tests"))
+    return rows, query
+
+
+def test_failures_in_node_id_order_use_outcome_index(database):
+    rows, query = traced_tests(database, outcome="failed")
+    assert "INDEXED BY tests_outcome_node_id" in query
+    assert [row["node_id"] for row in rows] == [
+        f"tests/test_{i:03d}.py::test" for i in range(0, 200, 7)
+    ]
+    # A range scan that already yields node ID order (no sort step)
+    plan = [row[-1] for row in database.conn.execute(f"EXPLAIN QUERY PLAN {query}")]
+    assert plan == [
+        "SEARCH tests USING INDEX tests_outcome_node_id"
+        " (session_id=? AND test_outcome=?)"
+    ]
+
+    rows = database.tests(outcome="failed", prefix="tests/test_01")
+    assert [row["node_id"] for row in rows] == ["tests/test_014.py::test"]
+
+
+def test_database_without_outcome_index(database):
+    database.conn.execute("DROP INDEX tests_outcome_node_id")
+    reader = TallyDatabase(database.file_path)
+    assert "tests_outcome_node_id" not in reader.indexes
+    rows = reader.tests(outcome="failed", limit=3)
+    assert [row["node_id"] for row in rows] == [
+        "tests/test_000.py::test",
+        "tests/test_007.py::test",
+        "tests/test_014.py::test",
+    ]
+    reader.close()
+    with pytest.raises(sqlite3.OperationalError):
+        database.conn.execute(
+            "SELECT * FROM tests INDEXED BY tests_outcome_node_id"
+        ).fetchall()
@@ -0,0 +1,82 @@
+import threading
+
+import pytest
+
+from pytest_tally.classes import TallyReport, TallySession, TallyTest
+from pytest_tally.utils import TALLY_CODECS, decode_tally_data
+
+
+def make_test(node_id, outcome="passed", finished=True):
+    tally_test = TallyTest(node_id=node_id, test_outcome=outcome, start_ns=1_000)
+    phases = TallyTest.PHASES if finished else TallyTest.PHASES[:2]
+    for when in phases:
+        tally_test.reports[when] = TallyReport(node_id, when, "passed")
+        tally_test.record_phase(when, 0.5)
+    if finished:
+        tally_test.stop_ns = 2_000_001_000
+    return tally_test
+
+
+@pytest.mark.parametrize("name", list(TALLY_CODECS))
+def test_encode_matches_to_json(monkeypatch, name):
+    codec = TALLY_CODECS[name]
+    if not codec.is_available():
+        pytest.skip(f"{name} is not installed")
+    # Running tests report their elapsed time as of now
+    monkeypatch.setattr("time.perf_counter_ns", lambda: 1_500_001_000)
+    session = TallySession(config=None, num_tests_to_run=4)
+    for node_id in ("test_a.py::test_1", "test_a.py::test_2", "test_b.py::test_[ü]"):
+        session.tally_tests[node_id] = make_test(node_id)
+    session.tally_tests["test_c.py::test_1"] = make_test(
+        "test_c.py::test_1", outcome=None, finished=False
+    )
+
+    def check():
+        assert decode_tally_data(session.encode(codec)) == session.to_json()
+
+    check()
+    check()
+
+    # A finished test changes: its fragment is re-encoded once it is marked
+    session.tally_tests["test_a.py::test_2"].test_outcome = "failed"
+    session.mark_dirty("test_a.py::test_2")
+    session.outcome_counts["failed"] = 1
+    check()
+
+    # The running test finishes; unfinished tests are re-encoded every time
+    running = session.tally_tests["test_c.py::test_1"]
+    running.reports["teardown"] = TallyReport(running.node_id, "teardown", "passed")
+    running.test_outcome = "passed"
+    running.stop_ns = 2_000_001_000
+    check()
+
+    # A new test is added, and another session header value changes
+    session.tally_tests["test_d.py::test_1"] = make_test("test_d.py::test_1")
+    session.lastline = "5 passed in 2.00s"
+    check()
+
+    assert decode_tally_data(session.encode(codec, include_tests=False)) == (
+        session.to_json(include_tests=False)
+    )
+
+
+@pytest.mark.parametrize("name,include_tests", [("msgpack", True), ("json", False)])
+def test_encode_waits_for_session_lock(name, include_tests):
+    codec = TALLY_CODECS[name]
+    if not codec.is_available():
+        pytest.skip(f"{name} is not installed")
+    session = TallySession(config=None)
+    session.tally_tests["test_a.py::test_1"] = make_test("test_a.py::test_1")
+    encoded = []
+    # Hooks update the session under its lock; the flusher must not walk it
+    # meanwhile
+    with session.lock:
+        flusher = threading.Thread(
+            target=lambda: encoded.append(session.encode(codec, include_tests))
+        )
+        flusher.start()
+        flusher.join(0.2)
+        assert not encoded
+        session.tally_tests["test_a.py::test_2"] = make_test("test_a.py::test_2")
+    flusher.join()
+    assert decode_tally_data(encoded[0]) == session.to_json(include_tests)
@@ -0,0 +1,41 @@
+from pytest_tally.utils import HISTORY_HEADER, DurationHistory
+
+
+def test_history_round_trip(tmp_path):
+    file_path = tmp_path / "tally" / "durations"
+    history = DurationHistory(file_path, alpha=0.5)
+    history.update("test_a.py::test_1", 2.0)
+    history.update("test_a.py::test_1", 1.0)
+    history.update("test_b.py::test_[ünï\tcode]", 0.25)
+    history.save()
+
+    loaded = DurationHistory(file_path, alpha=0.5)
+    assert loaded.durations == history.durations
+    assert loaded.get("test_a.py::test_1") == 1.5
+    assert loaded.get("test_b.py::test_[ünï\tcode]") == 0.25
+    assert loaded.get("test_c.py::test_1", 3.0) == 3.0
+    assert not list(file_path.parent.glob(".*.tmp"))
+
+    # Node IDs not run again keep their history
+    loaded.update("test_a.py::test_1", 0.5)
+    loaded.save()
+    assert DurationHistory(file_path).durations == {
+        "test_a.py::test_1": 1.0,
+        "test_b.py::test_[ünï\tcode]": 0.25,
+    }
+
+
+def test_unreadable_history_is_ignored(tmp_path):
+    file_path = tmp_path / "durations"
+    file_path.write_bytes(b"not a history file")
+    assert DurationHistory(file_path).durations == {}
+
+    history = DurationHistory(file_path)
+    history.update("test_a", 1.0)
+    history.save()
+    # Cut off inside the array of means
+    file_path.write_bytes(file_path.read_bytes()[: HISTORY_HEADER.size + 4])
+    assert DurationHistory(file_path).durations == {}
+
+    file_path.write_bytes(b"")
+    assert DurationHistory(file_path).durations == {}
@@ -0,0 +1,45 @@
+import json
+
+ANSI_YELLOW = "\x1b[33m"
+
+
+def read_tally_data(pytester):
+    return json.loads((pytester.path / "tally-data.json").read_text())
+
+
+def test_lastline_matches_pytest_summary(pytester, tally_args):
+    pytester.makepyfile("""
+        import warnings
+
+        def test_a():
+            warnings.warn(UserWarning("careful"))
+
+        def test_b():
+            pass
+
+        def test_c():
+            pass
+        """)
+    result = pytester.runpytest(*tally_args, "-q", "-k", "not test_c")
+    result.assert_outcomes(passed=2, deselected=1, warnings=1)
+
+    data = read_tally_data(pytester)
+    summary = result.outlines[-1].rsplit(" in ", 1)[0]
+    assert summary == "2 passed, 1 deselected, 1 warning"
+    assert data["lastline"].rsplit(" in ", 1)[0] == summary
+    # Deselected tests and warnings make pytest's main color yellow
+    assert f"{ANSI_YELLOW} in " in data["lastline_ansi"]
+
+
+def test_lastline_without_terminal_reporter(pytester, tally_args):
+    pytester.makepyfile("""
+        def test_a():
+            pass
+
+        def test_b():
+            assert 0
+        """)
+    pytester.runpytest(*tally_args, "-p", "no:terminal")
+
+    data = read_tally_data(pytester)
+    assert data["lastline"].startswith("1 failed, 1 passed in ")
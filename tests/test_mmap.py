@@ -0,0 +1,94 @@
+import json
+from pathlib import Path
+
+from pytest_tally.utils import MmapStatusTable
+
+
+def test_status_table_round_trip(tmp_path):
+    node_ids = ["test_a.py::test_1", "test_a.py::test_2", "test_b.py::test_1"]
+    table = MmapStatusTable.create(tmp_path / "tally-data.mmap", node_ids)
+    table.start_test("test_a.py::test_1")
+    for when, duration in (("setup", 0.25), ("call", 1.5), ("teardown", 0.125)):
+        table.set_phase_duration("test_a.py::test_1", when, duration)
+    table.set_outcome("test_a.py::test_1", "failed")
+    table.finish_test("test_a.py::test_1")
+    table.start_test("test_a.py::test_2")
+
+    reader = MmapStatusTable(tmp_path / "tally-data.mmap")
+    counts = reader.counts()
+    assert counts["running"] == 1
+    assert counts["finished"] == 1
+    assert counts["outcomes"]["failed"] == 1
+
+    tests = reader.tally_tests()
+    # Tests that have not started are left out
+    assert list(tests) == ["test_a.py::test_1", "test_a.py::test_2"]
+    finished = tests["test_a.py::test_1"]
+    assert finished["test_outcome"] == "Failed"
+    assert finished["test_duration"] == 1.875
+    assert finished["phases"] == {"setup": 0.25, "call": 1.5, "teardown": 0.125}
+    assert finished["timer"] == {"elapsed": 1.875, "running": False, "finished": True}
+    assert tests["test_a.py::test_2"]["timer"]["running"] is True
+
+    digest = reader.digest()
+    table.set_outcome("test_a.py::test_2", "passed")
+    table.finish_test("test_a.py::test_2")
+    assert reader.digest() != digest
+    reader.close()
+    table.close()
+
+
+def test_mmap_run_publishes_absolute_table_path(pytester, tally_args):
+    pytester.makepyfile("""
+        def test_a():
+            pass
+
+        def test_not_collected(request):
+            # A test the status table has no slot for must not break the hook
+            request.config.hook.pytest_runtest_logstart(
+                nodeid="not_collected.py::test_x", location=("not_collected.py", 0, "")
+            )
+        """)
+    args = [arg for arg in tally_args if not arg.startswith("--tally-file=")]
+    result = pytester.runpytest(
+        *args, "--tally-format=mmap", "--tally-file=out/tally-data.json"
+    )
+    result.assert_outcomes(passed=2)
+
+    data = json.loads((pytester.path / "out" / "tally-data.json").read_text())
+    table_path = Path(data["tally_table"])
+    assert table_path.is_absolute()
+    assert table_path == (pytester.path / "out" / "tally-data.mmap").resolve()
+    table = MmapStatusTable(table_path)
+    assert table.counts()["finished"] == 2
+    table.close()
+
+
+def test_mmap_run_updates_header_mid_run(pytester, tally_args):
+    pytester.makepyfile("""
+        import json
+        import time
+        from pathlib import Path
+
+        def test_a():
+            time.sleep(0.2)
+
+        def test_b():
+            time.sleep(0.1)
+
+        def test_c():
+            # The header (not just the status table) follows the run
+            deadline = time.monotonic() + 5
+            while True:
+                data = json.loads(Path("tally-data.json").read_text())
+                if data["num_tests_finished"] == 2 or time.monotonic() > deadline:
+                    break
+                time.sleep(0.05)
+            assert data["num_tests_finished"] == 2
+            assert [entry["node_id"] for entry in data["slowest"]["test"]] == [
+                "test_mmap_run_updates_header_mid_run.py::test_a",
+                "test_mmap_run_updates_header_mid_run.py::test_b",
+            ]
+        """)
+    result = pytester.runpytest(*tally_args, "--tally-format=mmap")
+    result.assert_outcomes(passed=3)
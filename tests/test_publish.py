@@ -0,0 +1,76 @@
+import json
+import os
+import threading
+
+from pytest_tally.utils import (
+    READER_RACY_TIME,
+    AtomicJsonFileUtils,
+    CachedJsonFileReader,
+    LocakbleJsonFileUtils,
+)
+
+
+def test_lock_mode_run_in_fresh_directory(pytester, tally_args):
+    pytester.makepyfile("""
+        def test_a():
+            pass
+        """)
+    args = [arg for arg in tally_args if not arg.startswith("--tally-file=")]
+    result = pytester.runpytest(
+        *args, "--tally-publish=lock", "--tally-file=out/tally-data.json"
+    )
+    result.assert_outcomes(passed=1)
+    data = json.loads((pytester.path / "out" / "tally-data.json").read_text())
+    assert data["session_finished"] is True
+    assert data["num_tests_finished"] == 1
+
+
+def test_reader_waits_for_in_place_write(tmp_path):
+    file_path = tmp_path / "tally-data.json"
+    writer = LocakbleJsonFileUtils(file_path)
+    writer.overwrite_json({"lastline": "old"})
+    new = json.dumps({"lastline": "new " * 1000}).encode()
+
+    read = []
+    writer._acquire_overwrite_lock()
+    try:
+        # Half written: a reader that does not wait would fail to decode it
+        writer.file.write(new[: len(new) // 2])
+        writer.file.flush()
+        reader = threading.Thread(
+            target=lambda: read.append(AtomicJsonFileUtils(file_path).read_json())
+        )
+        reader.start()
+        reader.join(0.2)
+        assert not read
+        writer.file.write(new[len(new) // 2 :])
+        writer.file.truncate()
+    finally:
+        writer._release_lock()
+    reader.join()
+    assert read == [json.loads(new)]
+
+
+def test_reader_sees_same_size_rewrite_in_one_mtime_granule(tmp_path, monkeypatch):
+    file_path = tmp_path / "tally-data.json"
+    writer = LocakbleJsonFileUtils(file_path)
+    writer.overwrite_json({"lastline": "1 passed"})
+    stat = file_path.stat()
+    reader = CachedJsonFileReader(file_path)
+    assert reader.read_json() == {"lastline": "1 passed"}
+    assert reader.read_json() == {"lastline": "1 passed"}
+    assert (reader.hits, reader.misses, reader.generation) == (1, 1, 1)
+
+    # Rewritten in place: same inode, same size and (coarse) mtime
+    writer.overwrite_json({"lastline": "1 failed"})
+    os.utime(file_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert reader.fingerprint() == (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    assert reader.read_json() == {"lastline": "1 failed"}
+    assert (reader.misses, reader.generation) == (2, 2)
+
+    # Once read well after its mtime, the fingerprint alone answers
+    monkeypatch.setattr("time.time", lambda: stat.st_mtime_ns / 1e9 + READER_RACY_TIME)
+    assert reader.read_json() == {"lastline": "1 failed"}
+    monkeypatch.setattr(reader.file_utils, "read_bytes", None)
+    assert reader.read_json() == {"lastline": "1 failed"}
+    assert (reader.hits, reader.misses, reader.generation) == (3, 2, 2)
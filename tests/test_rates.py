@@ -0,0 +1,81 @@
+import json
+
+from pytest_tally.classes import TallyRates
+from pytest_tally.utils import current_rates, format_rates
+
+
+def test_rates_fall_without_republishing(monkeypatch):
+    clock = [1000.25]
+    monkeypatch.setattr("time.time", lambda: clock[0])
+    rates = TallyRates(window=5)
+    rates.start()
+    for outcome in ("passed", "passed", "failed", None):
+        clock[0] += 0.5
+        rates.record(outcome)
+    published = json.loads(json.dumps(rates.to_json()))
+    assert published["tests_per_sec"] == 2.0
+    assert published["outcomes_per_sec"]["passed"] == 1.0
+    assert published["outcomes_per_sec"]["failed"] == 0.5
+    assert current_rates(published, now=clock[0]) == published
+
+    # A client re-evaluates the same data as time goes by
+    later = current_rates(published, now=clock[0] + 2)
+    assert later["tests_per_sec"] == 1.0
+    assert later["overall_tests_per_sec"] == 1.0
+    gone = current_rates(published, now=clock[0] + 10)
+    assert gone["tests_per_sec"] == 0.0
+    assert set(gone["outcomes_per_sec"].values()) == {0.0}
+    clock[0] += 2
+    assert (
+        format_rates(published)
+        == "1.0 tests/s (last 5s), 1.0 tests/s overall [passed 0.5/s, failed 0.2/s]"
+    )
+
+    # ... but not past the end of the session
+    clock[0] -= 2
+    rates.stop()
+    finished = json.loads(json.dumps(rates.to_json()))
+    assert current_rates(finished, now=clock[0] + 10) == finished
+    assert finished["overall_tests_per_sec"] == 2.0
+
+
+def test_format_rates_of_older_data_files():
+    rates = {
+        "window": 10,
+        "tests_per_sec": 1.5,
+        "overall_tests_per_sec": 2.0,
+        "outcomes_per_sec": {"passed": 1.5, "failed": 0.0},
+    }
+    assert (
+        format_rates(rates)
+        == "1.5 tests/s (last 10s), 2.0 tests/s overall [passed 1.5/s]"
+    )
+    assert format_rates(None) == ""
+
+
+def test_mmap_run_publishes_rates_mid_run(pytester, tally_args):
+    pytester.makepyfile("""
+        import json
+        import time
+        from pathlib import Path
+
+        def test_a():
+            time.sleep(0.2)
+
+        def test_b():
+            time.sleep(0.1)
+
+        def test_c():
+            deadline = time.monotonic() + 5
+            while True:
+                rates = json.loads(Path("tally-data.json").read_text())["rates"]
+                if rates["num_finished"] == 2 or time.monotonic() > deadline:
+                    break
+                time.sleep(0.05)
+            # Clients decay the rates from the buckets between two writes
+            assert rates["num_finished"] == 2
+            assert sum(sum(counts) for _, counts in rates["buckets"]) == 2
+            assert rates["finished_at"] is None
+        """)
+    result = pytester.runpytest(*tally_args, "--tally-format=mmap")
+    result.assert_outcomes(passed=3)
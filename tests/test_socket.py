@@ -0,0 +1,78 @@
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from pytest_tally.utils import (
+    SOCKET_PATH_MAX,
+    TallySocketServer,
+    TallySocketSubscriber,
+    socket_path_for,
+)
+
+
+def test_socket_path_next_to_data_file(tmp_path):
+    assert socket_path_for(tmp_path / "tally-data.json") == tmp_path / "tally-data.sock"
+
+
+def test_socket_path_too_long_for_af_unix(tmp_path):
+    deep = tmp_path / ("d" * 60) / ("e" * 60) / "tally-data.json"
+    socket_path = socket_path_for(deep)
+    assert socket_path.parent == Path(tempfile.gettempdir())
+    assert len(os.fsencode(socket_path)) <= SOCKET_PATH_MAX
+    # Stable, so that clients find the socket the plugin listens on
+    assert socket_path_for(deep) == socket_path
+
+
+def test_socket_run_in_deep_directory(pytester, tally_args):
+    pytester.makepyfile("""
+        def test_a():
+            pass
+        """)
+    deep = pytester.path / ("d" * 60) / ("e" * 60) / "tally-data.json"
+    args = [arg for arg in tally_args if not arg.startswith("--tally-file=")]
+    result = pytester.runpytest(*args, "--tally-socket", f"--tally-file={deep}")
+    result.assert_outcomes(passed=1)
+    assert deep.exists()
+
+
+def test_subscriber_skips_events_included_in_snapshot():
+    subscriber = TallySocketSubscriber(Path("unused.sock"))
+    test = {"node_id": "test_a", "test_outcome": None}
+    subscriber.apply({"event": "snapshot", "seq": 5, "session": {"tally_tests": {}}})
+    subscriber.apply({"event": "test_start", "seq": 5, "test": test})
+    assert subscriber.read_json()["tally_tests"] == {}
+
+    subscriber.apply({"event": "test_start", "seq": 6, "test": test})
+    assert subscriber.read_json()["tally_tests"] == {"test_a": test}
+    # A new session's server numbers its records from the start again
+    subscriber.apply({"event": "snapshot", "seq": 0, "session": {}})
+    subscriber.apply({"event": "session_start", "seq": 1, "session": {"n": 1}})
+    assert subscriber.read_json() == {"n": 1, "tally_tests": {}}
+
+
+def test_publish_does_not_wait_for_snapshot(tmp_path):
+    received = threading.Event()
+
+    def snapshot():
+        # Publishing while a snapshot is being encoded must not block
+        server.publish({"event": "during_snapshot"})
+        return b'{"tally_tests":{}}'
+
+    server = TallySocketServer(socket_path_for(tmp_path / "d.json"), snapshot)
+    server.start()
+    subscriber = TallySocketSubscriber(
+        server.socket_path, on_update=lambda: received.set()
+    )
+    subscriber.start()
+    try:
+        deadline = time.monotonic() + 5
+        while subscriber.sequence < 2 and time.monotonic() < deadline:
+            received.wait(0.1)
+            received.clear()
+        assert subscriber.snapshot_seq == 0
+        assert subscriber.sequence == 2
+    finally:
+        subscriber.close()
+        server.close()